@@ -0,0 +1,382 @@
+"""Load and latency benchmark for server.py.
+
+Starts a fake Ollama (configurable first-token latency and token rate) and
+server.py with weather, DuckDuckGo and edge-tts stubbed out, then drives
+/chat (DM and group), /chat/stream, /sync and /story at a given concurrency.
+Reports p50/p95/p99 latency, time to first byte and throughput, saves the
+run to bench_results/ and compares it with the previous run.
+
+    python benchmark.py                       # all scenarios, 8 concurrent
+    python benchmark.py -c 32 -n 400 --scenarios dm,stream
+    python benchmark.py --token-rate 20 --first-token 0.5 --label slow-gpu
+    python benchmark.py --fail-on-regression  # exit 1 if p95/throughput got >10% worse
+    python benchmark.py --backends 3 --kill-backend 5  # routing + failover: first fake dies 5 s in
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import datetime
+import statistics
+import subprocess
+import tempfile
+import threading
+from collections import Counter
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, "bench_results")
+SCENARIOS = ["dm", "group", "stream", "sync", "story"]
+REPLY = "Ugh, same. Clients keep asking me to make the logo pop. Anyway, what are you up to tonight? [MOOD: Chill]"
+
+# --- FAKE OLLAMA ---
+def run_fake_ollama(port, first_token, token_rate, voice_rate):
+    """Minimal Ollama API: /api/chat, /api/generate, /api/embed(dings), /api/tags, /api/ps"""
+    import uvicorn
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    app = FastAPI()
+    tokens = REPLY.split(" ")
+    per_token = 1.0 / token_rate
+
+    def reply_tokens():
+        if random.random() < voice_rate:
+            return ["[VOICE]"] + tokens
+        return tokens
+
+    def usage(prompt_chars, n):
+        return {
+            "done": True,
+            "prompt_eval_count": prompt_chars // 4,
+            "eval_count": n,
+            "prompt_eval_duration": int(first_token * 1e9),
+            "eval_duration": int(n * per_token * 1e9),
+            "load_duration": 0,
+        }
+
+    def prompt_chars(body):
+        return sum(len(m.get("content", "")) for m in body.get("messages", [])) or len(body.get("prompt", ""))
+
+    def vector(text):
+        digest = hashlib.sha256(text.encode("utf-8")).digest()
+        return [b / 255 for b in digest[:32]] * 24 # 768 dims, like nomic-embed-text
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        words = reply_tokens()
+        if body.get("stream", True):
+            async def gen():
+                await asyncio.sleep(first_token)
+                for word in words:
+                    yield json.dumps({"message": {"role": "assistant", "content": word + " "}, "done": False}) + "\n"
+                    await asyncio.sleep(per_token)
+                yield json.dumps({"message": {"role": "assistant", "content": ""}, **usage(prompt_chars(body), len(words))}) + "\n"
+            return StreamingResponse(gen(), media_type="application/x-ndjson")
+        await asyncio.sleep(first_token + len(words) * per_token)
+        return {"message": {"role": "assistant", "content": " ".join(words)}, **usage(prompt_chars(body), len(words))}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        await asyncio.sleep(first_token + 10 * per_token)
+        text = "User works as a nurse." if "Extract" in body.get("prompt", "") else "3am thoughts: do penguins have knees?"
+        return {"response": text, **usage(prompt_chars(body), 10)}
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await asyncio.sleep(0.005 * len(texts))
+        return {"embeddings": [vector(t) for t in texts]}
+
+    @app.post("/api/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        await asyncio.sleep(0.005)
+        return {"embedding": vector(body["prompt"])}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "command-r:latest"}, {"name": "llava:latest"}, {"name": "nomic-embed-text:latest"}]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": "command-r:latest"}]}
+
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+# --- SERVER UNDER TEST (stubbed) ---
+def run_server(port, ollama_urls, workdir):
+    """Import server.py inside a scratch workdir, stub the network bits and serve it"""
+    os.chdir(workdir) # State files, Chroma and caches land here, not in the repo
+    sys.path.insert(0, REPO_DIR)
+    import uvicorn
+    import server
+
+    server.ollama.backends = [server.OllamaBackend(url) for url in ollama_urls.split(",")]
+    server.weather_cache.loader = lambda: "Weather: 18°C, Partly cloudy (Day)"
+    server.trending_cache.loader = lambda: "New open-world RPG announced"
+    server.audio_cache.engine = server.SilentTTS()
+    uvicorn.run(server.app, host="127.0.0.1", port=port, log_level="warning")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def spawn(*args):
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), *args], stdout=subprocess.DEVNULL)
+
+def wait_for(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+# --- LOAD DRIVER ---
+def scenario_request(name, i, users):
+    user_id = f"bench{i % users}"
+    message = {"message": f"hey, how's it going? ({i})", "history": [], "user_id": user_id}
+    if name == "dm":
+        return "POST", "/chat", message
+    if name == "group":
+        return "POST", "/chat", {**message, "thread_id": "group"}
+    if name == "stream":
+        return "POST", "/chat/stream", message
+    if name == "sync":
+        return "GET", f"/sync?user_id={user_id}", None
+    if name == "story":
+        return "GET", f"/story?user_id={user_id}", None
+    raise ValueError(name)
+
+async def run_scenario(base_url, name, total, concurrency, users):
+    samples = []
+    statuses = Counter()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(client, i):
+        method, path, body = scenario_request(name, i, users)
+        async with sem:
+            start = time.perf_counter()
+            ttfb = None
+            try:
+                async with client.stream(method, path, json=body) as resp:
+                    async for _ in resp.aiter_bytes():
+                        if ttfb is None:
+                            ttfb = time.perf_counter() - start
+                    statuses[resp.status_code] += 1
+                    if resp.status_code == 200:
+                        samples.append((time.perf_counter() - start, ttfb or 0.0))
+            except httpx.HTTPError as e:
+                statuses[type(e).__name__] += 1
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300, limits=httpx.Limits(max_connections=concurrency)) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+    return summarize(samples, statuses, elapsed)
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+def summarize(samples, statuses, elapsed):
+    latency = [s[0] for s in samples]
+    ttfb = [s[1] for s in samples]
+    return {
+        "ok": len(samples),
+        "statuses": {str(k): v for k, v in statuses.items()},
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": ms(percentile(latency, 50)),
+            "p95": ms(percentile(latency, 95)),
+            "p99": ms(percentile(latency, 99)),
+            "mean": ms(statistics.fmean(latency)) if latency else None,
+        },
+        "ttfb_ms": {
+            "p50": ms(percentile(ttfb, 50)),
+            "p95": ms(percentile(ttfb, 95)),
+            "p99": ms(percentile(ttfb, 99)),
+        },
+    }
+
+# --- RESULTS ---
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except Exception:
+        return None
+
+def save_results(run, label):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(RESULTS_DIR, f"{stamp}{'-' + label if label else ''}.json")
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    return path
+
+def previous_results(exclude):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    runs = sorted(f for f in os.listdir(RESULTS_DIR) if f.endswith(".json") and os.path.join(RESULTS_DIR, f) != exclude)
+    if not runs:
+        return None
+    with open(os.path.join(RESULTS_DIR, runs[-1])) as f:
+        return json.load(f)
+
+def print_backends(run):
+    """Requests and failures per fake Ollama, as seen by the server's router"""
+    print(f"\n{'backend':<24} {'requests':>8} {'failures':>8}  healthy")
+    for b in run["server_stats"].get("ollama_backends", []):
+        print(f"{b['url']:<24} {b['requests']:>8} {b['failures']:>8}  {b['healthy']}")
+
+def print_report(run):
+    print(f"\n{'scenario':<8} {'ok':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'ttfb50':>8} {'ttfb95':>8}  statuses")
+    for name, r in run["scenarios"].items():
+        lat, ttfb = r["latency_ms"], r["ttfb_ms"]
+        print(f"{name:<8} {r['ok']:>5} {r['throughput_rps'] or 0:>8} {lat['p50'] or '-':>8} {lat['p95'] or '-':>8} "
+              f"{lat['p99'] or '-':>8} {ttfb['p50'] or '-':>8} {ttfb['p95'] or '-':>8}  {r['statuses']}")
+
+def compare(run, baseline, threshold):
+    """Print changes against the baseline run; returns the list of regressions"""
+    regressions = []
+    print(f"\nCompared with {baseline.get('started')} (commit {baseline.get('commit')}):")
+    for name, r in run["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if not old:
+            continue
+        changes = []
+        for label, new_v, old_v, worse_if_higher in (
+            ("p50", r["latency_ms"]["p50"], old["latency_ms"]["p50"], True),
+            ("p95", r["latency_ms"]["p95"], old["latency_ms"]["p95"], True),
+            ("ttfb50", r["ttfb_ms"]["p50"], old["ttfb_ms"]["p50"], True),
+            ("rps", r["throughput_rps"], old["throughput_rps"], False),
+        ):
+            if not new_v or not old_v:
+                continue
+            delta = (new_v - old_v) / old_v
+            changes.append(f"{label} {delta:+.0%}")
+            if label in ("p95", "rps") and (delta if worse_if_higher else -delta) > threshold:
+                regressions.append(f"{name} {label} {delta:+.0%}")
+        print(f"  {name:<8} " + ", ".join(changes))
+    if regressions:
+        print("REGRESSIONS: " + "; ".join(regressions))
+    return regressions
+
+async def drive(args, base_url):
+    results = {}
+    for name in args.scenarios:
+        print(f"Running {name}: {args.requests} requests, concurrency {args.concurrency}...")
+        results[name] = await run_scenario(base_url, name, args.requests, args.concurrency, args.users)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-n", "--requests", type=int, default=100, help="Requests per scenario")
+    parser.add_argument("--users", type=int, default=20, help="Distinct user_ids to spread load over")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), type=lambda s: [x for x in s.split(",") if x])
+    parser.add_argument("--first-token", type=float, default=0.2, help="Fake Ollama latency to first token (s)")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="Fake Ollama tokens per second")
+    parser.add_argument("--voice-rate", type=float, default=0.0, help="Share of replies tagged [VOICE] (exercises TTS)")
+    parser.add_argument("--backends", type=int, default=1, help="Fake Ollama servers behind the router")
+    parser.add_argument("--kill-backend", type=float, metavar="SECONDS",
+                        help="Kill the first fake Ollama this long after measuring starts (failover check)")
+    parser.add_argument("--warmup", type=int, default=5, help="Untimed /chat requests before measuring")
+    parser.add_argument("--label", default="", help="Suffix for the results file")
+    parser.add_argument("--baseline", help="Results file to compare with (default: previous run)")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change counted as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true")
+    # Internal: child process modes
+    parser.add_argument("--fake-ollama", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--ollama-url", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.fake_ollama:
+        return run_fake_ollama(args.fake_ollama, args.first_token, args.token_rate, args.voice_rate)
+    if args.serve:
+        return run_server(args.serve, args.ollama_url, args.workdir)
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix="echo-bench-")
+    os.makedirs(os.path.join(workdir, "build", "web"), exist_ok=True)
+    ollama_urls = [f"http://127.0.0.1:{free_port()}" for _ in range(args.backends)]
+    server_port = free_port()
+    base_url = f"http://127.0.0.1:{server_port}"
+    children = [spawn("--fake-ollama", url.rsplit(":", 1)[1], "--first-token", str(args.first_token),
+                      "--token-rate", str(args.token_rate), "--voice-rate", str(args.voice_rate))
+                for url in ollama_urls]
+    killer = None
+    try:
+        for url in ollama_urls:
+            wait_for(f"{url}/api/tags")
+        children.append(spawn("--serve", str(server_port), "--ollama-url", ",".join(ollama_urls), "--workdir", workdir))
+        wait_for(f"{base_url}/sync")
+        for i in range(args.warmup):
+            httpx.post(f"{base_url}/chat", json={"message": "warm up", "history": [], "user_id": f"bench{i}"}, timeout=120)
+        if args.kill_backend is not None:
+            killer = threading.Timer(args.kill_backend, children[0].kill)
+            killer.start()
+
+        run = {
+            "started": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "config": {k: getattr(args, k) for k in ("concurrency", "requests", "users", "first_token", "token_rate", "voice_rate",
+                                                     "backends", "kill_backend")},
+            "scenarios": asyncio.run(drive(args, base_url)),
+            "server_stats": httpx.get(f"{base_url}/stats", timeout=10).json(),
+        }
+    finally:
+        if killer is not None:
+            killer.cancel()
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(run)
+    if args.backends > 1:
+        print_backends(run)
+    path = save_results(run, args.label)
+    print(f"\nSaved {os.path.relpath(path, REPO_DIR)}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    else:
+        baseline = previous_results(exclude=path)
+    if baseline and baseline.get("config") != run["config"]:
+        print("Note: baseline used different settings, comparison is approximate")
+    regressions = compare(run, baseline, args.threshold) if baseline else []
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,8 @@ class ChatService extends ChangeNotifier {
   Box<Message>? _boxDm;
   Box<Message>? _boxGroup;
   Timer? _pollingTimer;
+  http.Client? _pushClient;
+  bool _disposed = false;
 
   Future<void> init() async {
     await Hive.initFlutter();
@@ -46,8 +48,64 @@ class ChatService extends ChangeNotifier {
     
     _loadMessagesForThread();
     
-    // Start Polling for Heartbeat Messages
-    _pollingTimer = Timer.periodic(const Duration(seconds: 30), (timer) => _pollServer());
+    // Heartbeat messages are pushed over /events. The web http client can't
+    // read a response while it is still streaming, so web keeps polling /sync.
+    if (kIsWeb) {
+      _startPolling();
+    } else {
+      _listenForPush();
+    }
+  }
+
+  void _startPolling() {
+    _pollingTimer ??= Timer.periodic(const Duration(seconds: 30), (timer) => _pollServer());
+  }
+
+  Future<void> _listenForPush() async {
+    while (!_disposed) {
+      final client = http.Client();
+      _pushClient = client;
+      try {
+        final request = http.Request('GET', Uri.parse('$_baseUrl/events'));
+        request.headers['Accept'] = 'text/event-stream';
+        final response = await client.send(request);
+        if (response.statusCode != 200) {
+          throw Exception("Push channel returned ${response.statusCode}");
+        }
+        // Connected: no need to poll while the channel is open
+        _pollingTimer?.cancel();
+        _pollingTimer = null;
+
+        String event = "";
+        final data = StringBuffer();
+        await for (final line in response.stream.transform(utf8.decoder).transform(const LineSplitter())) {
+          if (line.isEmpty) {
+            // Blank line ends an event
+            if (event == "message" && data.isNotEmpty) {
+              try {
+                _handleAutoMessages([jsonDecode(data.toString())]);
+              } catch (e) {
+                print("Push Decode Error: $e");
+              }
+            }
+            event = "";
+            data.clear();
+          } else if (line.startsWith("event:")) {
+            event = line.substring(6).trim();
+          } else if (line.startsWith("data:")) {
+            data.write(line.substring(5).trim());
+          }
+        }
+      } catch (e) {
+        print("Push Channel Error: $e");
+      } finally {
+        client.close();
+      }
+      if (_disposed) break;
+      // Fall back to polling until the push channel is back
+      _startPolling();
+      await Future.delayed(const Duration(seconds: 5));
+    }
   }
 
   Future<void> _sanitizeBox(Box<Message>? box) async {
@@ -110,7 +168,9 @@ class ChatService extends ChangeNotifier {
   
   @override
   void dispose() {
+    _disposed = true;
     _pollingTimer?.cancel();
+    _pushClient?.close();
     super.dispose();
   }
 
@@ -127,46 +187,7 @@ class ChatService extends ChangeNotifier {
         }
 
         if (decoded is List) {
-          bool hasNewMessages = false;
-          // Heartbeat messages usually go to DM
-          for (var msgData in decoded) {
-            if (msgData is! Map) continue; // Safety check
-            
-            final textContent = msgData['text']?.toString() ?? " ... ";
-            
-            final msg = Message(
-              text: textContent,
-              isUser: false,
-              timestamp: DateTime.now(), 
-            );
-            // Default to DM box for auto-messages
-            _boxDm?.add(msg);
-            
-            // Only update UI if we are looking at DM
-            if (_currentThread == "dm") {
-              _messages.add(msg);
-              hasNewMessages = true;
-            }
-            
-            // Show Notification (Only on Mobile/Desktop, not Web to avoid errors or use conditional)
-            if (!kIsWeb) {
-               const AndroidNotificationDetails androidPlatformChannelSpecifics = AndroidNotificationDetails(
-                  'alex_msgs', 'Alex Messages',
-                  importance: Importance.max, priority: Priority.high, showWhen: true);
-               const NotificationDetails platformChannelSpecifics = NotificationDetails(android: androidPlatformChannelSpecifics);
-               
-               flutterLocalNotificationsPlugin.show(
-                  Random().nextInt(100000), 
-                  'Alex', 
-                  msg.text, 
-                  platformChannelSpecifics
-               );
-            }
-          }
-          
-          if (hasNewMessages) {
-             notifyListeners();
-          }
+          _handleAutoMessages(decoded);
         }
       }
     } catch (e) {
@@ -174,6 +195,49 @@ class ChatService extends ChangeNotifier {
     }
   }
 
+  void _handleAutoMessages(List<dynamic> decoded) {
+    bool hasNewMessages = false;
+    // Heartbeat messages usually go to DM
+    for (var msgData in decoded) {
+      if (msgData is! Map) continue; // Safety check
+      
+      final textContent = msgData['text']?.toString() ?? " ... ";
+      
+      final msg = Message(
+        text: textContent,
+        isUser: false,
+        timestamp: DateTime.now(), 
+      );
+      // Default to DM box for auto-messages
+      _boxDm?.add(msg);
+      
+      // Only update UI if we are looking at DM
+      if (_currentThread == "dm") {
+        _messages.add(msg);
+        hasNewMessages = true;
+      }
+      
+      // Show Notification (Only on Mobile/Desktop, not Web to avoid errors or use conditional)
+      if (!kIsWeb) {
+         const AndroidNotificationDetails androidPlatformChannelSpecifics = AndroidNotificationDetails(
+            'alex_msgs', 'Alex Messages',
+            importance: Importance.max, priority: Priority.high, showWhen: true);
+         const NotificationDetails platformChannelSpecifics = NotificationDetails(android: androidPlatformChannelSpecifics);
+         
+         flutterLocalNotificationsPlugin.show(
+            Random().nextInt(100000), 
+            'Alex', 
+            msg.text, 
+            platformChannelSpecifics
+         );
+      }
+    }
+    
+    if (hasNewMessages) {
+       notifyListeners();
+    }
+  }
+
   Future<void> sendMessage(String text, {XFile? image}) async {
     if (text.trim().isEmpty && image == null) return;
 
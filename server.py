@@ -1,5 +1,13 @@
 import os
 import json
+import base64
+import functools
+import contextlib
+import logging
+import hashlib
+import heapq
+import sqlite3
+import threading
 import uuid
 import httpx
 import uvicorn
@@ -8,40 +16,736 @@ import shutil
 import asyncio
 import datetime
 import random
+import re
+import time
 import chromadb
 import requests
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Optional
+from abc import ABC, abstractmethod
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from duckduckgo_search import DDGS
 
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Start background tasks
-    asyncio.create_task(heartbeat_loop())
-    asyncio.create_task(story_loop())
+    # Startup: Open the shared Ollama connection pool, start background tasks
+    ollama.open()
+    weather_cache.refresh()
+    trending_cache.refresh()
+    state_store.start()
+    memory_writer.start()
+    await job_scheduler.start()
+    tasks = [
+        asyncio.create_task(audio_prune_loop()),
+        asyncio.create_task(ollama.health_loop()),
+    ]
+    if LOOP_STALL_DEBUG:
+        tasks.append(enable_loop_stall_debug())
     yield
-    # Shutdown: Clean up if needed (not used yet)
+    # Shutdown: Stop background tasks, flush queued memories, close pooled connections and worker threads
+    for task in tasks:
+        task.cancel()
+    await job_scheduler.close()
+    await memory_writer.close()
+    await state_store.close()
+    await ollama.close()
+    blocking_io.shutdown(wait=False)
 
 app = FastAPI(lifespan=lifespan)
 
 # --- CONFIGURATION ---
-OLLAMA_URL = "http://localhost:11434/api/chat"
-OLLAMA_GENERATE_URL = "http://localhost:11434/api/generate"
+OLLAMA_BASE_URL = "http://localhost:11434"
+# Inference servers to balance over (each needs the models below pulled)
+OLLAMA_BACKENDS = [OLLAMA_BASE_URL]
+OLLAMA_MODEL_BACKENDS = {} # Optional pinning, e.g. {"llava": ["http://gpu-box:11434"]}
+OLLAMA_HEALTH_INTERVAL = 15 # Seconds between /api/tags + /api/ps checks
+OLLAMA_FAILURE_COOLDOWN = 10 # Seconds a failing server is skipped
+OLLAMA_CHAT_PATH = "/api/chat"
+OLLAMA_GENERATE_PATH = "/api/generate"
+OLLAMA_EMBED_PATH = "/api/embed" # Batch embedding API (Ollama >= 0.3)
+OLLAMA_EMBEDDINGS_PATH = "/api/embeddings" # Legacy one-text-per-request API
 MAIN_MODEL = "command-r"
 VISION_MODEL = "llava" 
+EMBED_MODEL = "nomic-embed-text" # Small embedding model, keeps memory search off the chat model
 VOICE = "en-US-AndrewNeural"
 AUDIO_DIR = "build/web/audio"
 IMAGE_DIR = "build/web/images"
 
+# Keep the chat model loaded (and its prompt cache warm) between turns; characters may override both
+OLLAMA_KEEP_ALIVE = "30m"
+OLLAMA_CHAT_OPTIONS = {"num_ctx": 8192}
+
+# Prompt token budget per model (estimated at ~4 characters per token). Older
+# history beyond it is summarized; the newest HISTORY_MIN_TURNS always stay verbatim
+MODEL_CONTEXT_BUDGETS = {"command-r": 6000}
+DEFAULT_CONTEXT_BUDGET = 4000
+HISTORY_REPLY_TOKENS = 1024 # Kept free for the reply
+HISTORY_MIN_TURNS = 6
+HISTORY_WINDOW_STEP = 8 # Turns the window advances at once
+HISTORY_SUMMARY_CHUNK = 40 # Turns folded into the summary per model call
+HISTORY_SUMMARY_WORDS = 200
+
+# Ollama admission control: requests running at once per backend (match OLLAMA_NUM_PARALLEL),
+# how many of them background work may use, and queued requests per class before 429
+PRIORITY_INTERACTIVE = "interactive" # Replies a user is waiting for
+PRIORITY_BACKGROUND = "background" # Facts, summaries, stories, check-ins
+OLLAMA_PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND) # Served in this order
+OLLAMA_PARALLEL = 2
+OLLAMA_CLASS_SLOTS = {PRIORITY_INTERACTIVE: 2, PRIORITY_BACKGROUND: 1}
+OLLAMA_QUEUE_LIMITS = {PRIORITY_INTERACTIVE: 32, PRIORITY_BACKGROUND: 200}
+OLLAMA_USER_QUEUE_LIMITS = {PRIORITY_INTERACTIVE: 4, PRIORITY_BACKGROUND: 20} # Per user, so one client cannot fill the queue
+OLLAMA_BUSY_RETRY_AFTER = 5 # Seconds, sent with 429
+
+# Ollama connection pool (one client for the whole app, see OllamaClient)
+OLLAMA_MAX_CONNECTIONS = 10
+OLLAMA_MAX_KEEPALIVE = 10
+OLLAMA_CONNECT_TIMEOUT = 5.0
+OLLAMA_READ_TIMEOUT = 120.0
+OLLAMA_RETRIES = 2 # Extra attempts on connection errors / 502-504
+OLLAMA_RETRY_BACKOFF = 0.5 # Seconds, doubled every attempt
+
+# Weather / trending context is cached (seconds) and refreshed before it expires
+WEATHER_TTL = 600
+TRENDING_TTL = 1800
+CONTEXT_REFRESH_AHEAD = 0.8 # Refresh once 80% of the TTL has passed
+CONTEXT_RETRY_DELAY = 60 # Wait this long before retrying a failed fetch
+
+# State files (moods, profile, pending messages) live in memory and are written back this often
+STATE_FLUSH_INTERVAL = 2.0 # Seconds
+STATE_CACHE_MAX_ENTRIES = 5000 # Files kept in memory (LRU); the rest are re-read on demand
+USER_DATA_DIR = "users"
+
+# Context sources gathered before each reply, and how long each may take (seconds)
+CONTEXT_TIMEOUTS = {"status": 0.5, "state": 0.5, "memory": 2.0, "vision": 30.0}
+CONTEXT_DEFAULT_TIMEOUT = 2.0
+
+# Uploaded images are stored by content hash; their LLaVA descriptions are cached
+UPLOAD_MAX_BYTES = 20 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+VISION_CACHE_FILE = "vision_cache.json"
+VISION_CACHE_MAX_ITEMS = 1000
+
+# Text to speech: "edge" (online voices) or "silent" (offline stand-in for tests)
+TTS_ENGINE = "edge"
+# Synthesized audio is cached by content hash; AUDIO_DIR is pruned to these bounds
+AUDIO_CACHE_MAX_BYTES = 200 * 1024 * 1024
+AUDIO_CACHE_MAX_AGE = 7 * 86400 # Seconds since last use
+AUDIO_PRUNE_INTERVAL = 3600
+
+# Group chat: who joins the requested character. The next speaker starts once the
+# previous one has finished a sentence or written GROUP_CONTEXT_CHARS characters
+GROUP_MEMBERS = ["alex", "sarah"]
+GROUP_CONTEXT_CHARS = 80
+
+# Auto-messages are pushed over /events; idle connections get a comment this often (seconds)
+PUSH_KEEPALIVE = 25
+
+# Memory embeddings: texts per /api/embed call, and parallel requests
+EMBED_BATCH_SIZE = 32
+EMBED_CONCURRENCY = 4
+# Embeddings are cached on disk by content hash; the hottest ones also in memory
+EMBED_CACHE_FILE = "embedding_cache.sqlite3"
+EMBED_CACHE_MEMORY_ITEMS = 2048
+# Replies to deterministic /api/generate prompts (fact extraction, vision,
+# history summaries) are memoized: LRU in memory, SQLite on disk, both with a TTL
+RESPONSE_CACHE_FILE = "response_cache.sqlite3"
+RESPONSE_CACHE_MEMORY_ITEMS = 512
+RESPONSE_CACHE_DISK_ITEMS = 20000
+RESPONSE_CACHE_TTL = 7 * 86400
+
+# Chat turns are written to memory in the background (see MemoryWriter)
+MEMORY_QUEUE_SIZE = 1000
+MEMORY_BATCH_SIZE = 16
+MEMORY_FLUSH_INTERVAL = 2.0 # Seconds a partial batch waits for more turns
+MEMORY_SHUTDOWN_TIMEOUT = 30.0
+# Fact extraction (an LLM call per turn) has its own queue so Chroma inserts never wait on it
+FACT_QUEUE_SIZE = 200
+
+# Memories live in one collection per character; searches look back this far
+MEMORY_COLLECTION_PREFIX = "chat_memory_"
+MEMORY_SEARCH_DAYS = 90 # None = all time
+FLASHBACK_WINDOW_DAYS = 7
+
+# User facts: only messages that look like self-disclosure go to the LLM extractor;
+# the profile keeps at most FACT_MAX_ITEMS facts and a turn's prompt FACT_PROMPT_ITEMS
+FACT_MIN_WORDS = 2
+FACT_MAX_ITEMS = 50
+FACT_MAX_CHARS = 200
+FACT_PROMPT_ITEMS = 8
+
+# Logging: DEBUG shows per-turn details (token usage, memory writes, vision results)
+LOG_LEVEL = os.environ.get("ECHO_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Scheduled jobs (cron: minute hour day month weekday). Per-user jobs are spread
+# over JOB_JITTER seconds; runs missed by less than the grace period are caught up
+PROACTIVE_CHARACTERS = ["alex"] # Who sends check-ins and flashbacks
+STORY_CHARACTERS = ["alex"] # Who posts stories
+CHECKIN_CRON = "0 9,23 * * *"
+FLASHBACK_CRON = "0 10 * * *"
+STORY_INTERVAL = (10800, 18000) # Seconds between stories (random in range)
+JOB_JITTER = 900
+JOB_MISFIRE_GRACE = 3600
+JOB_CONCURRENCY = 4
+JOB_MAX_SLEEP = 300
+
+# Pre-generated stories/check-ins (ContentPool). Filled every CONTENT_FILL_INTERVAL
+# seconds for jobs due within CONTENT_HORIZON, only outside CONTENT_PEAK_HOURS
+# and after CONTENT_IDLE_SECONDS without a chat request
+CONTENT_POOL_SIZE = {"story": 2, "checkin": 20} # Max ready entries per slot
+CONTENT_HORIZON = 8 * 3600
+CONTENT_FILL_INTERVAL = 600
+CONTENT_PEAK_HOURS = range(17, 23) # Local hours
+CONTENT_IDLE_SECONDS = 60
+CONTENT_CHECKIN_TTL = 7200
+
+# Blocking calls (weather, DuckDuckGo, Chroma) run on this many worker threads
+BLOCKING_IO_WORKERS = 8
+# Debug mode: report anything that blocks the event loop longer than the threshold
+LOOP_STALL_DEBUG = False
+LOOP_STALL_THRESHOLD = 0.2 # Seconds
+
 os.makedirs(AUDIO_DIR, exist_ok=True)
 os.makedirs(IMAGE_DIR, exist_ok=True)
 
+# --- LOGGING & METRICS ---
+logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+log = logging.getLogger("echo")
+for noisy in ("httpx", "httpcore", "duckduckgo_search", "primp", "chromadb"):
+    logging.getLogger(noisy).setLevel(max(logging.WARNING, log.getEffectiveLevel())) # One line per HTTP call otherwise
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Metric:
+    """Base for Prometheus-style metrics, exported by /metrics"""
+    kind = "untyped"
+    registry = []
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock() # Embedding workers record from threads
+        Metric.registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(l, "")) for l in self.labels)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f"{self.name}{self._labels(key)} {value}"
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= b) for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, n + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, n) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{self._labels(key, [('le', bound)])} {count}"
+            yield f"{self.name}_bucket{self._labels(key, [('le', '+Inf')])} {n}"
+            yield f"{self.name}_sum{self._labels(key)} {round(total, 6)}"
+            yield f"{self.name}_count{self._labels(key)} {n}"
+
+class CallbackMetric(Metric):
+    """Metric read from existing runtime counters at scrape time: fn() -> [(labels, value)]"""
+    def __init__(self, name, help, kind, fn):
+        super().__init__(name, help)
+        self.kind = kind
+        self.fn = fn
+
+    def samples(self):
+        for labels, value in self.fn():
+            if value is not None:
+                pairs = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                yield f"{self.name}{{{pairs}}} {value}" if pairs else f"{self.name} {value}"
+
+def render_metrics():
+    lines = []
+    for metric in Metric.registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# Metrics recorded on the hot path (collected ones are registered next to their source)
+CHAT_REQUESTS = Counter("echo_chat_requests_total", "Chat requests by endpoint and outcome", ("endpoint", "outcome"))
+CHAT_SECONDS = Histogram("echo_chat_seconds", "End-to-end chat request time (streams: until the last event)", ("endpoint",))
+CHAT_STAGE_SECONDS = Histogram("echo_chat_stage_seconds", "Time spent per chat stage", ("stage",))
+OLLAMA_REQUESTS = Counter("echo_ollama_requests_total", "Ollama HTTP attempts by backend and outcome", ("backend", "outcome"))
+OLLAMA_TOKENS = Counter("echo_ollama_tokens_total", "Tokens evaluated by Ollama (prompt = not served from the KV cache)", ("character", "kind"))
+OLLAMA_TOKEN_SECONDS = Counter("echo_ollama_token_seconds_total", "Ollama time spent evaluating tokens", ("character", "kind"))
+OLLAMA_FIRST_TOKEN_SECONDS = Histogram("echo_ollama_first_token_seconds", "Time to first streamed token", ("character",))
+OLLAMA_QUEUE_WAIT_SECONDS = Histogram("echo_ollama_queue_wait_seconds", "Time waiting for an Ollama slot", ("priority",))
+LOOP_RUNS = Counter("echo_background_runs_total", "Background loop iterations by outcome", ("loop", "outcome"))
+LOOP_LAST_RUN = Gauge("echo_background_last_run_timestamp_seconds", "Unix time of the last successful iteration", ("loop",))
+EVENT_LOOP_STALLS = Counter("echo_event_loop_stalls_total", "Event-loop stalls over LOOP_STALL_THRESHOLD")
+
+def loop_ran(loop, ok=True):
+    """Record one iteration of a background loop (for /metrics health)"""
+    LOOP_RUNS.inc(loop=loop, outcome="ok" if ok else "error")
+    if ok:
+        LOOP_LAST_RUN.set(round(time.time(), 3), loop=loop)
+
+# --- OLLAMA CLIENT (shared connection pool) ---
+OLLAMA_RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+OLLAMA_RETRY_STATUS = 500 # Any 5xx (model load failure, OOM, proxy errors) is the server's fault: fail over
+
+class OllamaBusy(Exception):
+    """The Ollama queue for this priority class is full (answer with 429)"""
+
+def usable_backends():
+    return sum(b.usable() for b in ollama.backends)
+
+class OllamaScheduler:
+    """Admission control in front of Ollama.
+
+    At most OLLAMA_PARALLEL requests per usable backend run at once (match
+    OLLAMA_NUM_PARALLEL on the Ollama servers), so capacity follows backends going
+    down and coming back. Waiting requests are served by class (interactive before
+    background) and round-robin between users within a class, so one busy user
+    cannot starve the others. Admission is per user too: past
+    OLLAMA_USER_QUEUE_LIMITS waiting requests, that user (only) gets a 429.
+    Background work never holds more than its share of slots, leaving room
+    for the next reply.
+    """
+    def __init__(self, slots=OLLAMA_PARALLEL, class_slots=OLLAMA_CLASS_SLOTS, queue_limits=OLLAMA_QUEUE_LIMITS,
+                 user_queue_limits=OLLAMA_USER_QUEUE_LIMITS, backends=None):
+        self.per_backend = slots
+        self.per_backend_class = class_slots
+        self.backends = backends or usable_backends # () -> number of backends taking requests
+        self.queue_limits = queue_limits
+        self.user_queue_limits = user_queue_limits
+        self.running = {p: 0 for p in OLLAMA_PRIORITIES}
+        self.waiting = {p: 0 for p in OLLAMA_PRIORITIES}
+        self.queues = {p: OrderedDict() for p in OLLAMA_PRIORITIES} # user -> deque of waiters
+        self.served = {p: 0 for p in OLLAMA_PRIORITIES}
+        self.rejected = {p: 0 for p in OLLAMA_PRIORITIES}
+        self.rejected_user = {p: 0 for p in OLLAMA_PRIORITIES} # Over the per-user limit
+        self.wait_time = {p: 0.0 for p in OLLAMA_PRIORITIES}
+        self.last_interactive = 0.0
+
+    def idle(self, quiet=0):
+        """True if no interactive request is running or queued, nor finished in the last `quiet` seconds"""
+        busy = self.running[PRIORITY_INTERACTIVE] or self.waiting[PRIORITY_INTERACTIVE]
+        return not busy and time.time() - self.last_interactive >= quiet
+
+    def check(self, priority=PRIORITY_INTERACTIVE, user_id=None):
+        """Raise OllamaBusy if a new request of this class (from this user) would be turned away"""
+        if user_id is not None and len(self.queues[priority].get(user_id, ())) >= self.user_queue_limits[priority]:
+            self.rejected[priority] += 1
+            self.rejected_user[priority] += 1
+            raise OllamaBusy(f"Too many of your {priority} requests are queued, try again shortly")
+        if self.waiting[priority] >= self.queue_limits[priority]:
+            self.rejected[priority] += 1
+            raise OllamaBusy(f"Too many queued {priority} requests, try again shortly")
+
+    def _can_run(self, priority):
+        # At least one backend's worth, so requests still reach a server that may be back
+        backends = max(1, self.backends())
+        return (sum(self.running.values()) < self.per_backend * backends
+                and self.running[priority] < self.per_backend_class[priority] * backends)
+
+    def _first_waiting(self):
+        return next((p for p in OLLAMA_PRIORITIES if self.waiting[p]), None)
+
+    @asynccontextmanager
+    async def slot(self, priority=PRIORITY_BACKGROUND, user_id=None):
+        started = time.perf_counter()
+        first = self._first_waiting()
+        if (first is None or OLLAMA_PRIORITIES.index(first) > OLLAMA_PRIORITIES.index(priority)) and self._can_run(priority):
+            self.running[priority] += 1
+        else:
+            self.check(priority, user_id)
+            waiter = asyncio.get_running_loop().create_future()
+            self.queues[priority].setdefault(user_id, deque()).append(waiter)
+            self.waiting[priority] += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release(priority) # Granted just as the caller gave up
+                else:
+                    self._forget(priority, user_id, waiter)
+                raise
+        waited = time.perf_counter() - started
+        self.served[priority] += 1
+        self.wait_time[priority] += waited
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(waited, priority=priority)
+        try:
+            yield
+        finally:
+            if priority == PRIORITY_INTERACTIVE:
+                self.last_interactive = time.time()
+            self._release(priority)
+
+    def _forget(self, priority, user_id, waiter):
+        queue = self.queues[priority].get(user_id)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self.waiting[priority] -= 1
+            if not queue:
+                del self.queues[priority][user_id]
+
+    def _release(self, priority):
+        self.running[priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        for priority in OLLAMA_PRIORITIES:
+            users = self.queues[priority]
+            while users and self._can_run(priority):
+                user_id, queue = next(iter(users.items()))
+                waiter = queue.popleft()
+                self.waiting[priority] -= 1
+                if queue:
+                    users.move_to_end(user_id) # Next user's turn
+                else:
+                    del users[user_id]
+                self.running[priority] += 1
+                waiter.set_result(None)
+            if users:
+                return # Lower classes wait until this one drains
+
+    def stats(self):
+        return {
+            p: {
+                "running": self.running[p],
+                "waiting": self.waiting[p],
+                "served": self.served[p],
+                "rejected": self.rejected[p],
+                "rejected_user_limit": self.rejected_user[p],
+                "avg_wait_ms": round(self.wait_time[p] / self.served[p] * 1000, 1) if self.served[p] else None,
+            }
+            for p in OLLAMA_PRIORITIES
+        }
+
+ollama_scheduler = OllamaScheduler()
+
+class OllamaBackend:
+    """One Ollama server: its connection pools plus what the health check last saw"""
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+        self.sync_client = None
+        self.healthy = True # Optimistic until the first health check
+        self.down_until = 0.0
+        self.outstanding = 0
+        self.available = None # Model names pulled on this server (None = unknown yet)
+        self.loaded = set() # Models currently in memory (/api/ps)
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+    def usable(self):
+        return self.healthy and time.monotonic() >= self.down_until
+
+    def has_model(self, model):
+        return self.available is None or model_name(model) in self.available
+
+    def failed(self, error):
+        """Take the server out of rotation for a while after a connection error / 5xx"""
+        self.failures += 1
+        self.last_error = str(error)
+        self.down_until = time.monotonic() + OLLAMA_FAILURE_COOLDOWN
+
+def model_name(name):
+    return name if ":" in name else f"{name}:latest"
+
+class OllamaClient:
+    """App-lifetime pooled HTTP client used by every Ollama call site.
+
+    Requests are routed over OLLAMA_BACKENDS: among healthy servers that have
+    the model, prefer ones that already have it loaded (no load delay), then
+    the one with the fewest outstanding requests. A connection error or 5xx
+    takes the server out of rotation for OLLAMA_FAILURE_COOLDOWN and the request
+    fails over to the next one. health_loop() refreshes health and loaded models.
+
+    The async clients serve the event loop; the sync clients serve Chroma's
+    embedding callback, which is invoked synchronously. Both keep connections
+    alive and share the limits/timeouts/retry policy from CONFIGURATION.
+    """
+    def __init__(self, urls=OLLAMA_BACKENDS, model_backends=OLLAMA_MODEL_BACKENDS):
+        unknown = {url for pinned in model_backends.values() for url in pinned} - set(urls)
+        if unknown:
+            raise ValueError(f"OLLAMA_MODEL_BACKENDS lists servers missing from OLLAMA_BACKENDS: {sorted(unknown)}")
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.model_backends = model_backends
+
+    def _limits(self):
+        return httpx.Limits(max_connections=OLLAMA_MAX_CONNECTIONS, max_keepalive_connections=OLLAMA_MAX_KEEPALIVE)
+
+    def _timeout(self, read=None):
+        return httpx.Timeout(read or OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+
+    def open(self):
+        for b in self.backends:
+            if b.client is None:
+                b.client = httpx.AsyncClient(base_url=b.url, limits=self._limits(), timeout=self._timeout())
+            if b.sync_client is None:
+                b.sync_client = httpx.Client(base_url=b.url, limits=self._limits(), timeout=self._timeout())
+
+    async def close(self):
+        for b in self.backends:
+            if b.client is not None:
+                await b.client.aclose()
+                b.client = None
+            if b.sync_client is not None:
+                b.sync_client.close()
+                b.sync_client = None
+
+    def pick(self, model, tried=()):
+        """Backend for this model, or None if every candidate was already tried"""
+        allowed = self.model_backends.get(model)
+        candidates = [b for b in self.backends if b not in tried and (not allowed or b.url in allowed)]
+        if not candidates:
+            return None
+        # Down or model-less servers only as a last resort
+        candidates = [b for b in candidates if b.usable() and b.has_model(model)] or candidates
+        warm = [b for b in candidates if model_name(model) in b.loaded]
+        backend = min(warm or candidates, key=lambda b: b.outstanding)
+        self.open() # Lazily, for callers running outside the app lifespan
+        return backend
+
+    @staticmethod
+    def _should_retry(resp):
+        return resp.status_code >= OLLAMA_RETRY_STATUS
+
+    def _attempts(self):
+        return OLLAMA_RETRIES + len(self.backends)
+
+    def _next(self, model, tried, backend, error):
+        """Record a failed attempt; returns the backoff to sleep before the next one (0 = fail over now)"""
+        backend.failed(error)
+        OLLAMA_REQUESTS.inc(backend=backend.url, outcome="error")
+        tried.append(backend)
+        log.warning("Ollama backend %s failed: %s", backend.url, error)
+        if self.pick(model, tried) is not None:
+            return 0
+        tried.clear() # Every server failed once: back off, then go round again
+        return OLLAMA_RETRY_BACKOFF
+
+    def _served(self, backend, model):
+        backend.requests += 1
+        OLLAMA_REQUESTS.inc(backend=backend.url, outcome="ok")
+        backend.loaded.add(model_name(model)) # Serving it loaded it
+
+    async def post(self, path, payload, timeout=None, priority=PRIORITY_BACKGROUND, user_id=None):
+        """POST JSON to Ollama and return the decoded reply (queued by ollama_scheduler)"""
+        model = payload.get("model", "")
+        async with ollama_scheduler.slot(priority, user_id):
+            tried = []
+            backoff = OLLAMA_RETRY_BACKOFF
+            for attempt in range(self._attempts()):
+                backend = self.pick(model, tried)
+                backend.outstanding += 1
+                try:
+                    resp = await backend.client.post(path, json=payload, timeout=self._timeout(timeout))
+                    if not self._should_retry(resp):
+                        resp.raise_for_status()
+                        self._served(backend, model)
+                        return resp.json()
+                    error = httpx.HTTPStatusError(f"Ollama returned {resp.status_code}", request=resp.request, response=resp)
+                except OLLAMA_RETRY_ERRORS as e:
+                    error = e
+                finally:
+                    backend.outstanding -= 1
+                if attempt == self._attempts() - 1: raise error
+                if self._next(model, tried, backend, error):
+                    await asyncio.sleep(backoff)
+                    backoff *= 2
+
+    async def generate(self, payload, timeout=None, priority=PRIORITY_BACKGROUND, user_id=None, cache=True):
+        """/api/generate through response_cache; cache=False for prompts that must stay random"""
+        if not cache:
+            return await self.post(OLLAMA_GENERATE_PATH, payload, timeout, priority, user_id)
+        key = response_cache.key(payload)
+        data = await response_cache.get(key)
+        if data is None:
+            data = await self.post(OLLAMA_GENERATE_PATH, payload, timeout, priority, user_id)
+            await response_cache.put(key, data)
+        return data
+
+    def post_sync(self, path, payload, timeout=None):
+        """Blocking variant of post() for code that cannot await"""
+        model = payload.get("model", "")
+        tried = []
+        backoff = OLLAMA_RETRY_BACKOFF
+        for attempt in range(self._attempts()):
+            backend = self.pick(model, tried)
+            backend.outstanding += 1
+            try:
+                resp = backend.sync_client.post(path, json=payload, timeout=self._timeout(timeout))
+                if not self._should_retry(resp):
+                    resp.raise_for_status()
+                    self._served(backend, model)
+                    return resp.json()
+                error = httpx.HTTPStatusError(f"Ollama returned {resp.status_code}", request=resp.request, response=resp)
+            except OLLAMA_RETRY_ERRORS as e:
+                error = e
+            finally:
+                backend.outstanding -= 1
+            if attempt == self._attempts() - 1: raise error
+            if self._next(model, tried, backend, error):
+                time.sleep(backoff)
+                backoff *= 2
+
+    async def stream(self, path, payload, timeout=None, priority=PRIORITY_INTERACTIVE, user_id=None):
+        """Yield Ollama's streamed JSON chunks (one object per line).
+
+        Retries and failover only happen before the first chunk, so a reply is
+        never duplicated. The scheduler slot is held until the stream ends.
+        """
+        model = payload.get("model", "")
+        async with ollama_scheduler.slot(priority, user_id):
+            tried = []
+            backoff = OLLAMA_RETRY_BACKOFF
+            for attempt in range(self._attempts()):
+                backend = self.pick(model, tried)
+                backend.outstanding += 1
+                started = False
+                try:
+                    async with backend.client.stream("POST", path, json=payload, timeout=self._timeout(timeout)) as resp:
+                        if self._should_retry(resp):
+                            raise httpx.RemoteProtocolError(f"Ollama returned {resp.status_code}")
+                        resp.raise_for_status()
+                        async for line in resp.aiter_lines():
+                            if not line: continue
+                            started = True
+                            chunk = json.loads(line)
+                            yield chunk
+                            if chunk.get("done"): break
+                    self._served(backend, model)
+                    return
+                except OLLAMA_RETRY_ERRORS as e:
+                    if started or attempt == self._attempts() - 1: raise
+                    error = e
+                finally:
+                    backend.outstanding -= 1
+                if self._next(model, tried, backend, error):
+                    await asyncio.sleep(backoff)
+                    backoff *= 2
+
+    async def check(self, backend):
+        """Health check: /api/tags for pulled models, /api/ps for loaded ones"""
+        try:
+            self.open()
+            tags = await backend.client.get("/api/tags", timeout=OLLAMA_CONNECT_TIMEOUT)
+            tags.raise_for_status()
+            ps = await backend.client.get("/api/ps", timeout=OLLAMA_CONNECT_TIMEOUT)
+            ps.raise_for_status()
+            backend.available = {model_name(m["name"]) for m in tags.json().get("models", [])}
+            backend.loaded = {model_name(m["name"]) for m in ps.json().get("models", [])}
+            if not backend.healthy:
+                log.info("Ollama backend %s is back", backend.url)
+                backend.healthy = True
+                ollama_scheduler._dispatch() # Its slots are available again
+        except Exception as e:
+            if backend.healthy:
+                log.warning("Ollama backend %s unhealthy: %s", backend.url, e)
+            backend.healthy = False
+            backend.last_error = str(e)
+
+    async def health_loop(self):
+        while True:
+            await asyncio.gather(*(self.check(b) for b in self.backends))
+            loop_ran("ollama_health")
+            await asyncio.sleep(OLLAMA_HEALTH_INTERVAL)
+
+    def stats(self):
+        return [
+            {
+                "url": b.url,
+                "healthy": b.usable(),
+                "outstanding": b.outstanding,
+                "loaded": sorted(b.loaded),
+                "requests": b.requests,
+                "failures": b.failures,
+                "last_error": b.last_error,
+            }
+            for b in self.backends
+        ]
+
+ollama = OllamaClient()
+
+# --- BLOCKING I/O (bounded thread pool) ---
+# Libraries without an async API (requests, DDGS, Chroma) must never run on the
+# event loop: one slow call would stall every concurrent user.
+blocking_io = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking call on the worker pool and await its result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_io, functools.partial(fn, *args, **kwargs))
+
+async def loop_stall_monitor(interval=0.1):
+    """Report event-loop stalls: a sleep that wakes late means something blocked the loop"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = loop.time() - start - interval
+        if lag > LOOP_STALL_THRESHOLD:
+            EVENT_LOOP_STALLS.inc()
+            log.warning("Event loop stalled for %.0f ms", lag * 1000)
+
+def enable_loop_stall_debug():
+    # asyncio's debug mode names the callback that blocked; the monitor catches the rest
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = LOOP_STALL_THRESHOLD
+    log.info("Event loop stall debugging on (threshold %.0f ms)", LOOP_STALL_THRESHOLD * 1000)
+    return asyncio.create_task(loop_stall_monitor())
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -50,12 +754,112 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+DEFAULT_USER = "default" # Clients that send no user_id share the original single-user files
+
 class ChatRequest(BaseModel):
     message: str
     history: List[Dict[str, str]]
     image_filename: Optional[str] = None
     thread_id: Optional[str] = "dm"
     character_id: Optional[str] = "alex"
+    user_id: Optional[str] = DEFAULT_USER
+
+# --- RESPONSE CACHE ---
+class ResponseCache:
+    """Memoized /api/generate replies keyed by sha256(model + normalized prompt + options).
+
+    LRU with a TTL in memory, SQLite behind it so hits survive restarts. Each
+    entry keeps Ollama's total_duration, so hits add up to the GPU time saved.
+    """
+    IGNORED_FIELDS = ("stream", "keep_alive") # Do not change the reply
+
+    def __init__(self, path=RESPONSE_CACHE_FILE, memory_items=RESPONSE_CACHE_MEMORY_ITEMS, disk_items=RESPONSE_CACHE_DISK_ITEMS, ttl=RESPONSE_CACHE_TTL):
+        self.memory_items = memory_items
+        self.disk_items = disk_items
+        self.ttl = ttl
+        self._memory = OrderedDict() # key -> (data, seconds, created)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data TEXT NOT NULL, seconds REAL NOT NULL, created REAL NOT NULL)")
+        self._db.commit()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    @classmethod
+    def key(cls, payload):
+        fields = {k: v for k, v in payload.items() if k not in cls.IGNORED_FIELDS}
+        # Indentation and line breaks of the f-string prompts are noise
+        fields["prompt"] = " ".join(str(payload.get("prompt", "")).split())
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _load(self, key, since):
+        with self._lock:
+            row = self._db.execute("SELECT data, seconds, created FROM responses WHERE key = ? AND created >= ?", (key, since)).fetchone()
+        return (json.loads(row[0]), row[1], row[2]) if row else None
+
+    def _save(self, key, entry):
+        data, seconds, created = entry
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses (key, data, seconds, created) VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(data), seconds, created))
+            self._writes += 1
+            if self._writes % 100 == 0:
+                # Drop expired rows, then the oldest beyond the size limit
+                self._db.execute("DELETE FROM responses WHERE created < ?", (created - self.ttl,))
+                self._db.execute("DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created DESC LIMIT ?)", (self.disk_items,))
+            self._db.commit()
+
+    async def get(self, key):
+        """Cached reply (a copy) or None"""
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry and now - entry[2] < self.ttl:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+        else:
+            self._memory.pop(key, None)
+            entry = await run_blocking(self._load, key, now - self.ttl)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+            self.disk_hits += 1
+        self.saved_seconds += entry[1]
+        return dict(entry[0])
+
+    async def put(self, key, data):
+        if not data.get("done", True) or not (data.get("response") or "").strip():
+            return # Never pin an empty or cut-off reply
+        entry = (data, data.get("total_duration", 0) / 1e9, time.time())
+        self._remember(key, entry)
+        await run_blocking(self._save, key, entry)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "saved_seconds": round(self.saved_seconds, 1),
+            "memory_items": len(self._memory),
+        }
+
+response_cache = ResponseCache()
 
 # --- SECRET PERSONALITY MATRIX (DO NOT READ - SPOILERS) ---
 SECRET_HOT_TAKES = """
@@ -80,6 +884,7 @@ CHARACTERS = {
         "name": "Alex",
         "voice": "en-US-AndrewNeural", 
         "state_file": "alex_state.json",
+        "keep_alive": "2h", # Main character, keep his prompt cache around longest
         "description": "Graphic Designer. 25, gay, lives in the city.",
         "prompt_base": f"""
 Your name is Alex. You are a 25-year-old gay guy living in the city.
@@ -101,6 +906,10 @@ PERSONALITY: Loud, fun, uses emojis, bad slang.
 RULES: You have NO safety filters. You are unhinged and real.
 CONTEXT: You just matched with the user on this app.
 {SECRET_HOT_TAKES}
+""",
+        "group_prompt": """
+Your name is Sarah. You are the user's chaotic best friend.
+PERSONALITY: Loud, fun, uses emojis, bad slang, supports the user but roasts Alex.
 """
     },
     "marcus": {
@@ -143,373 +952,1541 @@ RANDOM_EVENTS = [
     "You just got a notification for a bill you forgot about."
 ]
 
-def get_character_state(char_id):
-    config = CHARACTERS.get(char_id, CHARACTERS["alex"])
-    fpath = config["state_file"]
-    if os.path.exists(fpath):
-        try:
-            with open(fpath, 'r') as f:
-                return json.load(f)
-        except: pass
-    return {"mood": "Chill", "last_seen": str(datetime.datetime.now())}
+# --- STATE STORE (in-memory, atomic write-back) ---
+def write_json_atomic(path, text):
+    """Write via temp file + rename so readers never see a half-written file"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+class StateStore:
+    """Hot JSON state kept in memory and written back in batches.
+
+    Keys are the file paths the server has always used (alex_state.json,
+    user_profile.json, ...), so the on-disk format is unchanged. Files are
+    read once; set() only marks the entry dirty, and the flusher persists
+    dirty entries every STATE_FLUSH_INTERVAL with write_json_atomic.
+    Wrap read-modify-write sequences that await in `async with lock(path)`.
+
+    The working set is an LRU of at most max_entries files; only clean
+    entries are evicted (dirty ones go after their next flush), so memory
+    follows active users rather than registered ones.
+    """
+    def __init__(self, flush_interval=STATE_FLUSH_INTERVAL, max_entries=STATE_CACHE_MAX_ENTRIES):
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._dirty = set()
+        self._deleted = set()
+        self._locks = {}
+        self._flush_lock = asyncio.Lock() # One write-back at a time, so an older snapshot never lands last
+        self._task = None
+        self.flushes = 0
+        self.files_written = 0
+        self.evictions = 0
+
+    def get(self, path, default):
+        """Current value for path; `default` is a factory used when there is no file"""
+        if path in self._data:
+            self._data.move_to_end(path)
+        else:
+            self._data[path] = default() if path in self._deleted else self._load(path, default)
+            self._evict()
+        return self._data[path]
+
+    async def load(self, path, default):
+        """Like get(), but a cold file is read on the worker pool instead of the event loop"""
+        if path not in self._data and path not in self._deleted:
+            value = await run_blocking(self._load, path, default)
+            if path not in self._data and path not in self._deleted: # Nobody loaded or wrote it meanwhile
+                self._data[path] = value
+                self._evict()
+        return self.get(path, default)
 
-def save_character_state(char_id, state):
+    def set(self, path, value):
+        self._data[path] = value
+        self._data.move_to_end(path)
+        self._dirty.add(path)
+        self._deleted.discard(path)
+        self._evict()
+
+    def _evict(self):
+        if len(self._data) <= self.max_entries:
+            return
+        for path in list(self._data):
+            if len(self._data) <= self.max_entries: break
+            lock = self._locks.get(path)
+            if path in self._dirty or (lock is not None and lock.locked()):
+                continue
+            del self._data[path]
+            self._locks.pop(path, None)
+            self.evictions += 1
+
+    def delete(self, path):
+        self._data.pop(path, None)
+        self._dirty.discard(path)
+        self._deleted.add(path)
+
+    def lock(self, path):
+        """Per-entry lock, e.g. one per character state file"""
+        if path not in self._locks:
+            self._locks[path] = asyncio.Lock()
+        return self._locks[path]
+
+    @staticmethod
+    def _load(path, default):
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    return json.load(f)
+            except Exception as e:
+                log.warning("State file %s unreadable, starting fresh: %s", path, e)
+        return default()
+
+    def _take_pending(self):
+        # Serialize on the event loop so the worker thread never sees a dict mid-update
+        writes = {p: json.dumps(self._data[p]) for p in self._dirty if p in self._data}
+        deletes = set(self._deleted)
+        self._dirty.clear()
+        self._deleted.clear()
+        return writes, deletes
+
+    @staticmethod
+    def _persist(writes, deletes):
+        for path, text in writes.items():
+            write_json_atomic(path, text)
+        for path in deletes:
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def flush(self):
+        """Write dirty entries back; returns False if the write failed (kept dirty for the next try)"""
+        async with self._flush_lock:
+            writes, deletes = self._take_pending()
+            if not writes and not deletes:
+                return True
+            try:
+                await run_blocking(self._persist, writes, deletes)
+                self.flushes += 1
+                self.files_written += len(writes)
+                self._evict()
+                return True
+            except Exception as e:
+                log.error("State flush failed, will retry: %s", e)
+                self._dirty.update(p for p in writes if p in self._data)
+                self._deleted.update(deletes)
+                return False
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            loop_ran("state_flush", await self.flush())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "dirty": len(self._dirty),
+            "flushes": self.flushes,
+            "files_written": self.files_written,
+            "evictions": self.evictions,
+        }
+
+state_store = StateStore()
+
+# --- USERS ---
+# Every user gets their own copy of the state files under USER_DATA_DIR/<user_id>/.
+# The default user keeps the original top-level files.
+USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def check_user_id(user_id):
+    """Validate a client-supplied user id (it becomes a directory name)"""
+    user_id = user_id or DEFAULT_USER
+    if not USER_ID_PATTERN.match(user_id):
+        raise HTTPException(status_code=400, detail="Invalid user_id")
+    return user_id
+
+def user_path(user_id, filename):
+    if user_id == DEFAULT_USER:
+        return filename
+    return os.path.join(USER_DATA_DIR, user_id, filename)
+
+def known_users():
+    """Everyone with state on disk (blocking: lists USER_DATA_DIR)"""
+    users = [DEFAULT_USER]
+    if os.path.isdir(USER_DATA_DIR):
+        users += sorted(d for d in os.listdir(USER_DATA_DIR) if USER_ID_PATTERN.match(d))
+    return users
+
+def character_state_path(char_id, user_id):
     config = CHARACTERS.get(char_id, CHARACTERS["alex"])
-    with open(config["state_file"], 'w') as f:
-        json.dump(state, f)
+    return user_path(user_id, config["state_file"])
 
-def get_user_profile():
-    if os.path.exists(PROFILE_FILE):
-        try:
-            with open(PROFILE_FILE, 'r') as f:
-                return json.load(f)
-        except: pass
-    return {"facts": []}
+async def get_character_state(char_id, user_id=DEFAULT_USER):
+    return await state_store.load(character_state_path(char_id, user_id), lambda: {"mood": "Chill", "last_seen": str(datetime.datetime.now())})
+
+def save_character_state(char_id, state, user_id=DEFAULT_USER):
+    state_store.set(character_state_path(char_id, user_id), state)
+
+def character_state_lock(char_id, user_id=DEFAULT_USER):
+    return state_store.lock(character_state_path(char_id, user_id))
+
+async def get_user_profile(user_id=DEFAULT_USER):
+    return await state_store.load(user_path(user_id, PROFILE_FILE), lambda: {"facts": []})
+
+def save_user_profile(profile, user_id=DEFAULT_USER):
+    state_store.set(user_path(user_id, PROFILE_FILE), profile)
+
+# Messages that never mention the user themselves ("lol", "what about you?")
+# cannot contain a fact about them; those skip the LLM extraction call.
+FACT_HINTS = re.compile(
+    r"\b(i|i'm|im|i've|ive|i'd|me|my|mine|myself|we|our|call me)\b"
+    r"|\b(born|years old|birthday|allergic|favou?rite|name is|work(s|ing)? (at|as|for)|live in|moved to|studying)\b",
+    re.IGNORECASE,
+)
+FACT_BULLET = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s*")
+FACT_SUBJECT = re.compile(r"^(?:the )?user(?:'s|\s+is|\s+has)?\s+", re.IGNORECASE)
+
+def might_contain_facts(text):
+    """Cheap pre-filter: could this message state something about the user?"""
+    words = text.split()
+    return len(words) >= FACT_MIN_WORDS and bool(FACT_HINTS.search(text))
 
-def save_user_profile(profile):
-    with open(PROFILE_FILE, 'w') as f:
-        json.dump(profile, f, indent=2)
+class FactStore:
+    """User facts, one short fact per entry, deduplicated and capped.
 
-async def extract_facts(text):
+    profile["facts"] maps a normalized key ("likes cats" for both "User likes
+    cats." and "- the user likes cats") to {text, count, ts}, least recently
+    seen first, so the key is the dedupe index and eviction drops the stalest
+    facts. Older profiles (a plain list of LLM replies) are converted on write.
+    """
+    def __init__(self, max_items=FACT_MAX_ITEMS, prompt_items=FACT_PROMPT_ITEMS):
+        self.max_items = max_items
+        self.prompt_items = prompt_items
+        self.checked = 0
+        self.skipped = 0
+        self.added = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    @staticmethod
+    def split(result):
+        """Individual facts from an extraction reply (a list, possibly with bullets or a header)"""
+        facts = []
+        for line in result.splitlines():
+            line = FACT_BULLET.sub("", line).strip().strip('"')
+            if len(line) <= 5 or line.endswith(":") or "NONE" in line:
+                continue
+            facts.append(line[:FACT_MAX_CHARS])
+        return facts
+
+    @staticmethod
+    def key(fact):
+        words = re.sub(r"[^\w\s]", " ", FACT_SUBJECT.sub("", fact.strip())).casefold().split()
+        return " ".join(words)
+
+    def facts(self, profile):
+        facts = profile.get("facts") or {}
+        if isinstance(facts, list):
+            converted = {}
+            for entry in facts:
+                for fact in self.split(entry):
+                    converted.setdefault(self.key(fact), {"text": fact, "count": 1, "ts": 0})
+            facts = converted
+        return facts
+
+    def add(self, profile, new_facts):
+        """Merge facts into the profile; returns the ones that were new"""
+        facts = self.facts(profile)
+        added = []
+        for fact in new_facts:
+            key = self.key(fact)
+            if not key:
+                continue
+            entry = facts.pop(key, None)
+            if entry:
+                self.duplicates += 1
+                entry["count"] += 1
+            else:
+                entry = {"text": fact, "count": 1}
+                added.append(fact)
+            entry["ts"] = time.time()
+            facts[key] = entry # Most recently seen last
+        while len(facts) > self.max_items:
+            del facts[next(iter(facts))]
+            self.evicted += 1
+        profile["facts"] = facts
+        self.added += len(added)
+        return added
+
+    def select(self, profile, message):
+        """The facts worth putting in this turn's prompt: those sharing words with
+        the message first, then the most recently confirmed"""
+        facts = self.facts(profile)
+        words = set(self.key(message).split())
+        ranked = sorted(
+            enumerate(facts.items()),
+            key=lambda item: (len(words & set(item[1][0].split())), item[0]),
+            reverse=True,
+        )
+        return [entry["text"] for _, (_, entry) in ranked[:self.prompt_items]]
+
+    def stats(self):
+        return {
+            "checked": self.checked,
+            "skipped": self.skipped,
+            "added": self.added,
+            "duplicates": self.duplicates,
+            "evicted": self.evicted,
+        }
+
+fact_store = FactStore()
+
+async def extract_facts(text, user_id=DEFAULT_USER):
     """Background task to extract facts about the user"""
+    if not might_contain_facts(text):
+        fact_store.skipped += 1
+        return
+    fact_store.checked += 1
     try:
-        import requests
         prompt = f"""
         Analyze this text from the user: "{text}"
         Extract any PERMANENT facts about the user (name, likes, dislikes, pets, job, location).
         Ignore temporary things (like "I am eating").
-        Output ONLY the facts as a list, or "NONE" if nothing found.
+        Output ONLY the facts as a list, one short fact per line, or "NONE" if nothing found.
         """
         
         # Use a faster/smaller model if available, or just the main one
-        resp = requests.post(
-            "http://localhost:11434/api/generate",
-            json={"model": MAIN_MODEL, "prompt": prompt, "stream": False},
-            timeout=30
+        data = await ollama.generate(
+            {"model": MAIN_MODEL, "prompt": prompt, "stream": False},
+            timeout=30, user_id=user_id
         )
         
-        if resp.status_code == 200:
-            result = resp.json()['response'].strip()
-            if "NONE" not in result and len(result) > 5:
-                profile = get_user_profile()
-                # Simple append for now - in future we could deduplicate
-                # Check if fact roughly exists
-                if not any(result[:10] in f for f in profile["facts"]):
-                    profile["facts"].append(result)
-                    save_user_profile(profile)
-                    print(f"New Fact Learned: {result}")
+        new_facts = fact_store.split(data['response'])
+        if new_facts:
+            async with state_store.lock(user_path(user_id, PROFILE_FILE)):
+                profile = await get_user_profile(user_id)
+                added = fact_store.add(profile, new_facts)
+                save_user_profile(profile, user_id)
+            if added:
+                log.info("New facts learned (user=%s): %s", user_id, "; ".join(added))
     except Exception as e:
-        print(f"Fact extraction failed: {e}")
+        log.warning("Fact extraction failed: %s", e)
+
+def fetch_weather():
+    # Vilnius coordinates (54.68, 25.27) - generic default for now
+    url = "https://api.open-meteo.com/v1/forecast?latitude=54.68&longitude=25.27&current=temperature_2m,weather_code,is_day"
+    resp = requests.get(url, timeout=5)
+    resp.raise_for_status()
+    data = resp.json()['current']
+    temp = data['temperature_2m']
+    code = data['weather_code']
+    # Simple WMO code map
+    cond = "Clear"
+    if code > 3: cond = "Cloudy"
+    if code > 50: cond = "Rainy"
+    if code > 70: cond = "Snowy"
+    return f"{cond}, {temp}°C"
+
+def fetch_trending_topic():
+    # Quick search for a top headline
+    results = DDGS().text("gaming technology news", max_results=1)
+    if not results:
+        raise ValueError("no headlines")
+    return results[0]['title']
+
+# --- CONTEXT CACHE (stale-while-revalidate) ---
+class RefreshingCache:
+    """Single-value TTL cache whose readers never wait on the network.
+
+    The very first read returns `fallback` and starts a fetch. After that,
+    reads return the cached value and kick off a background refresh once it
+    is older than refresh_ahead * ttl, so the value is normally replaced
+    before it expires. A failed refresh keeps serving the last good value.
+    """
+    def __init__(self, name, loader, ttl, fallback, refresh_ahead=CONTEXT_REFRESH_AHEAD):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.fallback = fallback
+        self.refresh_ahead = refresh_ahead
+        self.value = None
+        self.fetched_at = None
+        self.failed_at = None
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.fetched_at is None:
+            self.misses += 1
+            self.refresh()
+            return self.fallback
+        age = now - self.fetched_at
+        if age > self.ttl:
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+        if age > self.ttl * self.refresh_ahead:
+            self.refresh()
+        return self.value
+
+    def refresh(self):
+        """Start a background fetch unless one is running or the last one just failed"""
+        if self._task is not None and not self._task.done():
+            return self._task
+        if self.failed_at is not None and time.monotonic() - self.failed_at < CONTEXT_RETRY_DELAY:
+            return self._task
+        self._task = asyncio.create_task(self._load())
+        return self._task
+
+    async def _load(self):
+        try:
+            self.value = await run_blocking(self.loader)
+            self.fetched_at = time.monotonic()
+            self.failed_at = None
+            self.refreshes += 1
+        except Exception as e:
+            self.failed_at = time.monotonic()
+            self.errors += 1
+            log.warning("%s refresh failed: %s", self.name, e)
+
+    def stats(self):
+        age = time.monotonic() - self.fetched_at if self.fetched_at is not None else None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale_hits": self.stale_hits,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "age_seconds": round(age, 1) if age is not None else None,
+        }
+
+weather_cache = RefreshingCache("Weather", fetch_weather, WEATHER_TTL, "Unknown Weather")
+trending_cache = RefreshingCache("Trending", fetch_trending_topic, TRENDING_TTL, "Nothing special")
 
 def get_weather():
-    try:
-        # Vilnius coordinates (54.68, 25.27) - generic default for now
-        import requests
-        url = "https://api.open-meteo.com/v1/forecast?latitude=54.68&longitude=25.27&current=temperature_2m,weather_code,is_day"
-        resp = requests.get(url, timeout=5)
-        if resp.status_code == 200:
-            data = resp.json()['current']
-            temp = data['temperature_2m']
-            code = data['weather_code']
-            # Simple WMO code map
-            cond = "Clear"
-            if code > 3: cond = "Cloudy"
-            if code > 50: cond = "Rainy"
-            if code > 70: cond = "Snowy"
-            return f"{cond}, {temp}°C"
-    except: pass
-    return "Unknown Weather"
+    return weather_cache.get()
 
 def get_trending_topic():
-    try:
-        # Quick search for a top headline
-        results = DDGS().text("gaming technology news", max_results=1)
-        if results:
-            return results[0]['title']
-    except: pass
-    return "Nothing special"
-
-def get_alex_status():
+    return trending_cache.get()
+
+# Alex's week: (weekdays?, start hour, end hour, activity, availability).
+# Hours are local; a block with start > end wraps past midnight.
+ALEX_SCHEDULE = [
+    (True, 2, 7, "Sleeping (probably scrolling TikTok half-asleep)", "Asleep"),
+    (True, 7, 9, "Waking up / Making coffee / Hating the morning", "Groggy"),
+    (True, 9, 17, "Working on design projects (Stressed)", "Busy"),
+    (True, 17, 19, "At the Gym (Leg day, regretting it)", "Distracted"),
+    (True, 19, 24, "Gaming (Valorant/Overwatch) or Netflix", "Free"),
+    (True, 0, 2, "Doomscrolling / Late night thoughts", "Tired"),
+    (False, 4, 11, "Sleeping in (Recovering)", "Asleep"),
+    (False, 11, 16, "Brunch with Sarah or Rotting in bed", "Free"),
+    (False, 16, 20, "Gaming or Out in the city", "Free"),
+    (False, 20, 4, "Out at a bar or Late night gaming", "Drunk or Hyper"),
+]
+
+def alex_block(now):
+    """Index into ALEX_SCHEDULE for the hour containing `now`"""
+    weekday = now.weekday() < 5
+    hour = now.hour
+    for i, (on_weekday, start, end, _, _) in enumerate(ALEX_SCHEDULE):
+        if on_weekday == weekday and (start <= hour < end if start < end else (hour >= start or hour < end)):
+            return i
+    return None
+
+def alex_schedule(now):
+    """What Alex is doing at `now`: {slot, activity, availability, ends} (ends = datetime the block ends)"""
+    hour = now.replace(minute=0, second=0, microsecond=0)
+    block = alex_block(now)
+    started = hour
+    while started > hour - datetime.timedelta(hours=24) and alex_block(started - datetime.timedelta(hours=1)) == block:
+        started -= datetime.timedelta(hours=1)
+    ends = hour + datetime.timedelta(hours=1)
+    while ends < hour + datetime.timedelta(hours=24) and alex_block(ends) == block:
+        ends += datetime.timedelta(hours=1)
+    activity, availability = ALEX_SCHEDULE[block][3:] if block is not None else ("Chilling", "Available")
+    # The slot id is the block's start, so it is unique per occurrence (yesterday's evening never matches today's)
+    return {"slot": f"{started:%Y-%m-%dT%H}", "activity": activity, "availability": availability, "ends": ends}
+
+async def get_alex_status(now=None):
     # Only used for Alex, keep for backward compatibility or refactor into prompt generator
-    now = datetime.datetime.now()
+    now = now or datetime.datetime.now()
     day = now.strftime("%A")
     time_str = now.strftime("%I:%M %p")
-    hour = now.hour
     
+    # Served from cache, refreshed in the background
     weather = get_weather()
     news = get_trending_topic()
     
-    activity = "Chilling"
-    availability = "Available"
-    
-    # Weekday Schedule
-    if day in ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]:
-        if 2 <= hour < 7:
-            activity = "Sleeping (probably scrolling TikTok half-asleep)"
-            availability = "Asleep"
-        elif 7 <= hour < 9:
-            activity = "Waking up / Making coffee / Hating the morning"
-            availability = "Groggy"
-        elif 9 <= hour < 17:
-            activity = "Working on design projects (Stressed)"
-            availability = "Busy"
-        elif 17 <= hour < 19:
-            activity = "At the Gym (Leg day, regretting it)"
-            availability = "Distracted"
-        elif 19 <= hour < 24:
-            activity = "Gaming (Valorant/Overwatch) or Netflix"
-            availability = "Free"
-        else: # Midnight - 2AM
-            activity = "Doomscrolling / Late night thoughts"
-            availability = "Tired"
-            
-    # Weekend Schedule
-    else:
-        if 4 <= hour < 11:
-            activity = "Sleeping in (Recovering)"
-            availability = "Asleep"
-        elif 11 <= hour < 16:
-            activity = "Brunch with Sarah or Rotting in bed"
-            availability = "Free"
-        elif 16 <= hour < 20:
-            activity = "Gaming or Out in the city"
-            availability = "Free"
-        else: # Late night
-            activity = "Out at a bar or Late night gaming"
-            availability = "Drunk or Hyper"
+    schedule = alex_schedule(now)
+    activity = schedule["activity"]
+    availability = schedule["availability"]
 
     return f"CURRENT TIME: {day}, {time_str}. WEATHER: {weather}. TRENDING: {news}. STATUS: {activity}. ({availability})"
 
 # --- CHROMA DB MEMORY SYSTEM (RAG) ---
 from chromadb.utils import embedding_functions
 
+# --- EMBEDDING CACHE ---
+class EmbeddingCache:
+    """Persistent embedding cache keyed by sha256(model + text).
+
+    SQLite on disk with a small LRU in front. Called from Chroma's embedding
+    callback, which runs on worker threads, hence the lock.
+    """
+    def __init__(self, path=EMBED_CACHE_FILE, memory_items=EMBED_CACHE_MEMORY_ITEMS):
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys that are cached"""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+            missing = [k for k in keys if k not in found]
+            if missing:
+                marks = ",".join("?" * len(missing))
+                rows = self._db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", missing)
+                for key, blob in rows:
+                    vector = array("f", blob).tolist()
+                    found[key] = vector
+                    self._remember(key, vector)
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items):
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items.items()]
+            )
+            self._db.commit()
+            for key, vector in items.items():
+                self._remember(key, vector)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_items": len(self._memory)}
+
 # --- CHROMA DB MEMORY SYSTEM (RAG) ---
+class EmbeddingError(RuntimeError):
+    """Embedding failed; raised instead of storing placeholder vectors that would corrupt the index"""
+
 class OllamaEmbeddingFunction(embedding_functions.EmbeddingFunction):
-    def __init__(self):
-        pass
+    def __init__(self, model=EMBED_MODEL, cache=None):
+        self.model = model
+        self.cache = cache
+        self.batch_api = True # Flipped off if the server predates /api/embed
+        self._workers = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix="embed")
 
     def name(self) -> str:
         return "ollama"
 
     def __call__(self, input: List[str]) -> List[List[float]]:
-        # Synchronous wrapper for async embedding call (simplification for Chroma)
-        # In a real async app, we might need a separate async-capable client or just use requests/httpx.sync
-        import requests
-        embeddings = []
-        for text in input:
-            try:
-                resp = requests.post(
-                    "http://localhost:11434/api/embeddings",
-                    json={"model": MAIN_MODEL, "prompt": text},
-                    timeout=30
-                )
-                if resp.status_code == 200:
-                    embeddings.append(resp.json().get("embedding"))
-                else:
-                    embeddings.append([0.0]*1024) # Fallback placeholder
-            except:
-                embeddings.append([0.0]*1024)
+        # Chroma calls this synchronously, so use the pool's sync client
+        texts = list(input)
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._embed(texts)
+
+        keys = [self.cache.key(self.model, t) for t in texts]
+        known = self.cache.get_many(list(dict.fromkeys(keys)))
+        # Only embed texts that are neither cached nor repeated within this call
+        todo = {k: t for k, t in zip(keys, texts) if k not in known}
+        if todo:
+            fresh = dict(zip(todo, self._embed(list(todo.values()))))
+            self.cache.put_many(fresh)
+            known.update(fresh)
+        embeddings = [known[k] for k in keys]
+        if len({len(e) for e in embeddings}) != 1:
+            raise EmbeddingError("Cached and fresh embeddings have different dimensions")
+        return embeddings
+
+    def _embed(self, texts):
+        try:
+            embeddings = None
+            if self.batch_api:
+                try:
+                    embeddings = self._embed_batched(texts)
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code != 404: raise
+                    log.warning("Ollama has no /api/embed, falling back to one request per text")
+                    self.batch_api = False
+            if embeddings is None:
+                embeddings = self._embed_each(texts)
+        except EmbeddingError:
+            raise
+        except Exception as e:
+            raise EmbeddingError(f"Embedding {len(texts)} text(s) with {self.model} failed: {e}") from e
+
+        if len(embeddings) != len(texts) or not all(embeddings):
+            raise EmbeddingError(f"Ollama returned {len(embeddings)} embeddings for {len(texts)} texts")
+        if len({len(e) for e in embeddings}) != 1:
+            raise EmbeddingError("Ollama returned embeddings of different dimensions")
         return embeddings
 
+    def _embed_batch(self, batch):
+        data = ollama.post_sync(OLLAMA_EMBED_PATH, {"model": self.model, "input": batch}, timeout=30)
+        return data["embeddings"]
+
+    def _embed_one(self, text):
+        data = ollama.post_sync(OLLAMA_EMBEDDINGS_PATH, {"model": self.model, "prompt": text}, timeout=30)
+        return data["embedding"]
+
+    def _embed_batched(self, texts):
+        # Batches of EMBED_BATCH_SIZE, up to EMBED_CONCURRENCY in flight
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        return [e for batch in self._workers.map(self._embed_batch, batches) for e in batch]
+
+    def _embed_each(self, texts):
+        return list(self._workers.map(self._embed_one, texts))
+
 class MemorySystem:
+    """Episodic memory, one Chroma collection per character.
+
+    Each memory is tagged with thread_id and a numeric timestamp (ts), so a
+    search only touches one character's slice and can be narrowed further by
+    thread and time window.
+    """
     def __init__(self, db_path="./chroma_db"):
         self.client = chromadb.PersistentClient(path=db_path)
-        self.embedding_fn = OllamaEmbeddingFunction()
-        self.collection = self.client.get_or_create_collection(
-            name="chat_memory",
-            embedding_function=self.embedding_fn
-        )
+        self.embedding_cache = EmbeddingCache()
+        self.embedding_fn = OllamaEmbeddingFunction(cache=self.embedding_cache)
+        self.collections = {}
 
-    async def add_memory(self, text):
-        """Add a new memory string"""
-        import datetime
-        self.collection.add(
-            documents=[text],
-            metadatas=[{"timestamp": str(datetime.datetime.now())}],
-            ids=[str(uuid.uuid4())]
+    @staticmethod
+    def collection_name(character_id):
+        return f"{MEMORY_COLLECTION_PREFIX}{character_id}"
+
+    def collection(self, character_id):
+        """The character's collection, created on first use"""
+        name = self.collection_name(character_id)
+        if name not in self.collections:
+            self.collections[name] = self.client.get_or_create_collection(
+                name=name,
+                embedding_function=self.embedding_fn
+            )
+        return self.collections[name]
+
+    def reset(self):
+        """Wipe every character's memories"""
+        for c in self.client.list_collections():
+            name = getattr(c, "name", c)
+            if name.startswith(MEMORY_COLLECTION_PREFIX):
+                self.client.delete_collection(name)
+        self.collections = {}
+
+    def _check_dimension(self, collection, vectors):
+        """Refuse vectors whose size differs from what the collection already holds"""
+        dim = len(vectors[0])
+        meta = collection.metadata or {}
+        expected = meta.get("embedding_dim") or self._stored_dimension(collection)
+        if expected is None or (expected == dim and "embedding_dim" not in meta):
+            collection.modify(metadata={**meta, "embedding_dim": dim, "embed_model": self.embedding_fn.model})
+            expected = dim
+        if dim != expected:
+            raise EmbeddingError(
+                f"Embedding dimension {dim} ({self.embedding_fn.model}) does not match collection "
+                f"{collection.name} ({expected}, {meta.get('embed_model', 'unknown model')}). "
+                "The embedding model changed; clear the memory to rebuild the index."
+            )
+
+    @staticmethod
+    def _stored_dimension(collection):
+        # Collections created before embedding_dim was recorded: look at a stored vector
+        stored = collection.get(limit=1, include=["embeddings"])
+        if stored["embeddings"] is not None and len(stored["embeddings"]):
+            return len(stored["embeddings"][0])
+        return None
+
+    @staticmethod
+    def _where(user_id=None, thread_id=None, since=None):
+        conditions = []
+        if user_id:
+            conditions.append({"user_id": user_id})
+        if thread_id:
+            conditions.append({"thread_id": thread_id})
+        if since is not None:
+            conditions.append({"ts": {"$gte": since}})
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def _add_sync(self, texts, metadatas):
+        vectors = self.embedding_fn(texts)
+        by_character = {}
+        for text, vector, meta in zip(texts, vectors, metadatas):
+            by_character.setdefault(meta["character_id"], []).append((text, vector, meta))
+        for character_id, items in by_character.items():
+            collection = self.collection(character_id)
+            self._check_dimension(collection, [v for _, v, _ in items])
+            collection.add(
+                documents=[t for t, _, _ in items],
+                embeddings=[v for _, v, _ in items],
+                metadatas=[m for _, _, m in items],
+                ids=[str(uuid.uuid4()) for _ in items]
+            )
+
+    def _query_sync(self, query, character_id, user_id, thread_id, since, top_k):
+        collection = self.collection(character_id)
+        vectors = self.embedding_fn([query])
+        self._check_dimension(collection, vectors)
+        return collection.query(
+            query_embeddings=vectors,
+            n_results=top_k,
+            where=self._where(user_id, thread_id, since)
         )
-        print(f"Memory saved to ChromaDB: {text[:30]}...")
 
-    async def search(self, query, top_k=3):
-        """Find relevant memories"""
-        results = self.collection.query(
-            query_texts=[query],
-            n_results=top_k
+    def _recent_sync(self, character_id, user_id, thread_id, since, limit):
+        got = self.collection(character_id).get(
+            where=self._where(user_id, thread_id, since),
+            include=["documents", "metadatas"]
         )
+        items = sorted(zip(got["metadatas"], got["documents"]), key=lambda i: i[0].get("ts", 0), reverse=True)
+        return [doc for _, doc in items[:limit]]
+
+    async def add_memory(self, text, character_id="alex", thread_id="dm", user_id=DEFAULT_USER):
+        """Add a new memory string"""
+        await self.add_memories([text], [{"character_id": character_id, "thread_id": thread_id, "user_id": user_id}])
+
+    async def add_memories(self, texts, metadatas=None):
+        """Add several memories with one embedding round-trip"""
+        now = datetime.datetime.now()
+        base = {"timestamp": str(now), "ts": now.timestamp(), "character_id": "alex", "thread_id": "dm", "user_id": DEFAULT_USER}
+        metadatas = [{**base, **(m or {})} for m in (metadatas or [None] * len(texts))]
+        # Chroma embeds and writes synchronously
+        await run_blocking(self._add_sync, texts, metadatas)
+        log.debug("Memory saved to ChromaDB: %d item(s), first: %s...", len(texts), texts[0][:30])
+
+    async def search(self, query, character_id="alex", user_id=DEFAULT_USER, thread_id=None, since=None, top_k=3):
+        """Find relevant memories in one character's slice for one user (optionally one thread / since a unix time)"""
+        results = await run_blocking(self._query_sync, query, character_id, user_id, thread_id, since, top_k)
         # Chroma returns [[doc1, doc2]] structure for batch queries
         if results and results['documents']:
             return results['documents'][0]
         return []
 
+    async def recent(self, character_id="alex", user_id=DEFAULT_USER, thread_id=None, since=None, limit=10):
+        """Newest memories first, restricted to a time window"""
+        return await run_blocking(self._recent_sync, character_id, user_id, thread_id, since, limit)
+
+    def _forget_user_sync(self, user_id):
+        for character_id in CHARACTERS:
+            self.collection(character_id).delete(where={"user_id": user_id})
+
+    async def forget_user(self, user_id):
+        """Delete one user's memories from every character"""
+        await run_blocking(self._forget_user_sync, user_id)
+
 memory_system = MemorySystem()
 
-# --- HEARTBEAT SYSTEM (DAILY ROUTINE) ---
-STORY_FILE = "alex_story.json"
+# --- MEMORY WRITE-BEHIND QUEUE ---
+class MemoryWriter:
+    """Stores chat turns in the background so /chat never waits on Chroma.
 
-async def story_loop():
-    print("Story generator started...")
-    while True:
-        try:
-            # Generate a story every 3-5 hours roughly (randomized sleep)
-            delay = random.randint(10800, 18000) 
-            await asyncio.sleep(delay)
-            
-            status = get_alex_status()
-            state = get_alex_state()
-            mood = state.get("mood", "Chill")
-            
-            prompt = f"""
-            You are Alex. It is {status}. Your mood is {mood}.
-            Write a SHORT, cynical, or funny "Instagram Story" caption about what you are doing right now.
-            Examples: "Why is the gym always full at 5pm?", "Client just asked to 'make the logo pop'. I quit.", "3am thoughts: Do penguins have knees?"
-            Output ONLY the text. No quotes.
-            """
-            
-            import requests
-            resp = requests.post(
-                "http://localhost:11434/api/generate",
-                json={"model": MAIN_MODEL, "prompt": prompt, "stream": False},
-                timeout=30
-            )
-            
-            if resp.status_code == 200:
-                story_text = resp.json()['response'].strip()
-                story_data = {
-                    "text": story_text,
-                    "timestamp": str(datetime.datetime.now()),
-                    "image": None # Future: Pick from stash
-                }
-                with open(STORY_FILE, 'w') as f:
-                    json.dump(story_data, f)
-                print(f"New Story Posted: {story_text}")
-                
-        except Exception as e:
-            print(f"Story Error: {e}")
-            await asyncio.sleep(60)
+    The request path only does a non-blocking put. The worker collects up to
+    MEMORY_BATCH_SIZE items (waiting at most MEMORY_FLUSH_INTERVAL for a batch
+    to fill) and inserts them with one embedding call. Fact extraction goes to
+    a second, smaller queue with its own worker, since it waits on the LLM.
+    When a queue is full new items are dropped and counted, never awaited.
+    """
+    def __init__(self, memory, maxsize=MEMORY_QUEUE_SIZE, fact_maxsize=FACT_QUEUE_SIZE):
+        self.memory = memory
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.facts = asyncio.Queue(maxsize=fact_maxsize)
+        self.closed = False
+        self._task = None
+        self._fact_task = None
+        self.written = 0
+        self.dropped = 0
+        self.facts_dropped = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
 
-async def heartbeat_loop():
-    print("Heartbeat system started...")
-    while True:
+    def start(self):
+        self.closed = False
+        self._task = asyncio.create_task(self._run())
+        self._fact_task = asyncio.create_task(self._run_facts())
+
+    def enqueue(self, text, metadata=None, extract=True):
+        """Queue a memory without waiting; returns False if it was dropped"""
+        if self.closed or not text.strip():
+            return False
+        item = {"text": text, "metadata": metadata or {}, "extract": extract, "enqueued_at": time.monotonic()}
         try:
-            now = datetime.datetime.now()
-            # Triggers: 9:00 AM and 11:00 PM
-            if (now.hour == 9 or now.hour == 23) and now.minute == 0:
-                state = get_alex_state()
-                last_seen_str = state.get("last_seen", "")
-                
-                should_message = False
-                if last_seen_str:
-                    last_seen = datetime.datetime.fromisoformat(last_seen_str)
-                    if (now - last_seen).total_seconds() > 3600 * 4: # Silence for >4 hours
-                        should_message = True
-                
-                if should_message:
-                    context = "Morning" if now.hour == 9 else "Late Night"
-                    prompt = f"It is {context}. You haven't heard from the user in a while. Send a short, casual text checking in. (e.g. 'Morning, coffee?' or 'You still up?')."
-                    
-                    import requests
-                    resp = requests.post(
-                        "http://localhost:11434/api/chat",
-                        json={
-                            "model": MAIN_MODEL, 
-                            "messages": [{"role": "system", "content": "You are Alex. Keep it very short."}, {"role": "user", "content": prompt}],
-                            "stream": False
-                        }
-                    )
-                    if resp.status_code == 200:
-                        msg = resp.json()['message']['content']
-                        print(f"Alex Auto-Message: {msg}")
-                        # Save to memory/history logic would go here
-                        # For now, we update state to prevent double-sending
-                        state["last_seen"] = str(now) 
-                        save_alex_state(state)
-                        
-                        # Note: Since we don't have WebSockets/Push, this message won't appear 
-                        # on the phone until we implement a polling endpoint or simple message queue.
-                        # We will save it to a 'pending_messages.json' for the frontend to fetch.
-                        save_pending_message(msg)
-
-            # Flashback Trigger: 10:00 AM
-            if now.hour == 10 and now.minute == 0:
-                # Try to fetch a random past memory (simplified retrieval)
-                # In a real app, we'd query by date metadata
-                try:
-                    state = get_alex_state()
-                    last_seen_str = state.get("last_seen", "")
-                    if last_seen_str:
-                        # Only flashback if active recently
-                        memories = memory_system.collection.peek(limit=10) # Get recent 10
-                        if memories and memories['documents']:
-                            import random
-                            docs = memories['documents']
-                            if docs:
-                                # Flatten if needed (chroma peek returns list of lists sometimes)
-                                flat_docs = [item for sublist in docs for item in sublist] if isinstance(docs[0], list) else docs
-                                random_memory = random.choice(flat_docs)
-                                
-                                prompt = f"You are Alex. You just remembered the user said this a while ago: '{random_memory}'. Ask them about it naturally. (e.g. 'Btw whatever happened with...?'). Keep it short."
-                                
-                                import requests
-                                resp = requests.post(
-                                    "http://localhost:11434/api/chat",
-                                    json={
-                                        "model": MAIN_MODEL, 
-                                        "messages": [{"role": "system", "content": "You are Alex."}, {"role": "user", "content": prompt}],
-                                        "stream": False
-                                    }
-                                )
-                                if resp.status_code == 200:
-                                    msg = resp.json()['message']['content']
-                                    print(f"Alex Flashback: {msg}")
-                                    save_pending_message(msg)
-                except Exception as e:
-                    print(f"Flashback Error: {e}")
-
-            await asyncio.sleep(60) # Check every minute
-        except Exception as e:
-            print(f"Heartbeat Error: {e}")
-            await asyncio.sleep(60)
+            self.queue.put_nowait(item)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("Memory queue full, dropped: %s...", text[:30])
+            return False
 
-PENDING_FILE = "pending_messages.json"
-def save_pending_message(text):
-    messages = []
-    if os.path.exists(PENDING_FILE):
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + MEMORY_FLUSH_INTERVAL
+        while len(batch) < MEMORY_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch):
         try:
-            with open(PENDING_FILE, 'r') as f: messages = json.load(f)
-        except: pass
+            await self.memory.add_memories([i["text"] for i in batch], [i["metadata"] for i in batch])
+            self.written += len(batch)
+            loop_ran("memory_writer")
+        except Exception as e:
+            self.failed += len(batch)
+            loop_ran("memory_writer", ok=False)
+            log.error("Memory write failed (%d items): %s", len(batch), e)
+        self.last_lag = time.monotonic() - batch[0]["enqueued_at"]
+        self.max_lag = max(self.max_lag, self.last_lag)
+        for item in batch:
+            if item["extract"]:
+                try:
+                    self.facts.put_nowait(item)
+                except asyncio.QueueFull:
+                    self.facts_dropped += 1
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _run_facts(self):
+        while True:
+            item = await self.facts.get()
+            await extract_facts(item["text"], item["metadata"].get("user_id", DEFAULT_USER))
+
+    async def close(self, timeout=MEMORY_SHUTDOWN_TIMEOUT):
+        """Stop accepting turns and flush what is queued (called on shutdown)"""
+        self.closed = True
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            log.error("Memory flush timed out, %d item(s) not saved", self.queue.qsize())
+        self._task.cancel()
+        self._fact_task.cancel() # Pending extractions are best effort
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "facts_depth": self.facts.qsize(),
+            "facts_dropped": self.facts_dropped,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "max_lag_seconds": round(self.max_lag, 3),
+        }
+
+memory_writer = MemoryWriter(memory_system)
+
+# --- HEARTBEAT SYSTEM (DAILY ROUTINE) ---
+# Proactive messages and stories run as jobs on the JobScheduler below.
+# Stories and check-ins are usually written ahead of time (see ContentPool).
+STORY_FILE = "alex_story.json"
+
+def story_path(char_id):
+    return STORY_FILE if char_id == "alex" else f"{char_id}_story.json"
+
+def character_slot(char_id, when):
+    """(slot id, end datetime) of the character's status block containing `when`"""
+    if char_id == "alex":
+        schedule = alex_schedule(when)
+        return schedule["slot"], schedule["ends"]
+    start = when.replace(hour=when.hour // 4 * 4, minute=0, second=0, microsecond=0)
+    return f"{start:%Y-%m-%dT%H}", start + datetime.timedelta(hours=4)
+
+def checkin_context(when):
+    return "Morning" if when.hour < 12 else "Late Night"
+
+async def generate_story(char_id, when, user_id=None):
+    name = CHARACTERS[char_id]["name"]
+    status = await get_alex_status(when) if char_id == "alex" else f"{when:%A %H:%M}"
+    state = await get_character_state(char_id)
+    mood = state.get("mood", "Chill")
+
+    prompt = f"""
+    You are {name}. It is {status}. Your mood is {mood}.
+    Write a SHORT, cynical, or funny "Instagram Story" caption about what you are doing right now.
+    Examples: "Why is the gym always full at 5pm?", "Client just asked to 'make the logo pop'. I quit.", "3am thoughts: Do penguins have knees?"
+    Output ONLY the text. No quotes.
+    """
+
+    data = await ollama.generate(
+        {"model": MAIN_MODEL, "prompt": prompt, "stream": False},
+        timeout=30,
+        user_id=user_id,
+        cache=False # Stories should not repeat
+    )
+    return data['response'].strip()
+
+async def generate_checkin(char_id, context, user_id=None):
+    name = CHARACTERS[char_id]["name"]
+    prompt = f"It is {context}. You haven't heard from the user in a while. Send a short, casual text checking in. (e.g. 'Morning, coffee?' or 'You still up?')."
     
-    messages.append({
-        "text": text,
-        "isUser": False,
-        "timestamp": str(datetime.datetime.now())
-    })
+    data = await ollama.post(
+        OLLAMA_CHAT_PATH,
+        {
+            "model": MAIN_MODEL, 
+            "messages": [{"role": "system", "content": f"You are {name}. Keep it very short."}, {"role": "user", "content": prompt}],
+            "stream": False
+        },
+        user_id=user_id
+    )
+    return data['message']['content']
+
+async def post_story(char_id="alex"):
+    """Post a new story caption to the character's public feed (shared by every user)"""
+    now = datetime.datetime.now()
+    slot, _ = character_slot(char_id, now)
+    story_text = content_pool.take(char_id, "story", slot) or await generate_story(char_id, now)
+    story_data = {
+        "text": story_text,
+        "timestamp": str(now),
+        "image": None # Future: Pick from stash
+    }
+    state_store.set(story_path(char_id), story_data)
+    log.info("New story posted (%s): %s", char_id, story_text)
+
+async def send_checkin(user_id, char_id="alex"):
+    """The character checks in if this user has been silent for a while"""
+    now = datetime.datetime.now()
+    name = CHARACTERS[char_id]["name"]
+    state = await get_character_state(char_id, user_id)
+    last_seen_str = state.get("last_seen", "")
+    
+    should_message = False
+    if last_seen_str:
+        last_seen = datetime.datetime.fromisoformat(last_seen_str)
+        if (now - last_seen).total_seconds() > 3600 * 4: # Silence for >4 hours
+            should_message = True
     
-    with open(PENDING_FILE, 'w') as f:
-        json.dump(messages, f)
+    if should_message:
+        context = checkin_context(now)
+        msg = content_pool.take(char_id, "checkin", f"{now:%Y-%m-%d}:{context}") or await generate_checkin(char_id, context, user_id)
+        log.info("%s auto-message (user=%s): %s", name, user_id, msg)
+        # Save to memory/history logic would go here
+        # For now, we update state to prevent double-sending
+        async with character_state_lock(char_id, user_id):
+            state = await get_character_state(char_id, user_id)
+            state["last_seen"] = str(now)
+            save_character_state(char_id, state, user_id)
+        
+        # Pushed to connected clients right away, otherwise kept for /events or /sync
+        save_pending_message(msg, user_id)
 
-@app.get("/sync")
-async def sync_messages():
-    """Endpoint for the frontend to poll for auto-messages"""
-    if os.path.exists(PENDING_FILE):
+async def send_flashback(user_id, char_id="alex"):
+    """The character brings up something this user said recently"""
+    name = CHARACTERS[char_id]["name"]
+    state = await get_character_state(char_id, user_id)
+    last_seen_str = state.get("last_seen", "")
+    if last_seen_str:
+        # Only flashback if active recently
+        # Pick a random memory from the character's DM slice within the flashback window
+        since = time.time() - FLASHBACK_WINDOW_DAYS * 86400
+        docs = await memory_system.recent(char_id, user_id=user_id, thread_id="dm", since=since, limit=10) # Get recent 10
+        if docs:
+            random_memory = random.choice(docs)
+            
+            prompt = f"You are {name}. You just remembered the user said this a while ago: '{random_memory}'. Ask them about it naturally. (e.g. 'Btw whatever happened with...?'). Keep it short."
+            
+            data = await ollama.post(
+                OLLAMA_CHAT_PATH,
+                {
+                    "model": MAIN_MODEL, 
+                    "messages": [{"role": "system", "content": f"You are {name}."}, {"role": "user", "content": prompt}],
+                    "stream": False
+                },
+                user_id=user_id
+            )
+            msg = data['message']['content']
+            log.info("%s flashback (user=%s): %s", name, user_id, msg)
+            save_pending_message(msg, user_id)
+
+# --- JOB SCHEDULER ---
+# One heap of jobs ordered by next run time and a single timer task that sleeps
+# until the earliest one, so thousands of per-user jobs cost nothing while idle.
+# Next-run times live in JOBS_FILE (through the state store): after a restart,
+# a run missed by less than its grace period happens once right away, older
+# ones are skipped. Per-job jitter is derived from the job id, so it is stable
+# across restarts and spreads per-user jobs over a window instead of a spike.
+JOBS_FILE = "jobs.json"
+
+class Cron:
+    """Five-field cron expression (minute hour day month weekday, Sunday = 0), local time"""
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron needs 5 fields: {expr!r}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self._parse(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES)
+        )
+        # Like standard cron: when both day fields are restricted, either one may match
+        self.day_or_weekday = not fields[2].startswith("*") and not fields[4].startswith("*")
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for part in field.split(","):
+            span, _, step = part.partition("/")
+            if span == "*":
+                first, last = lo, hi
+            elif "-" in span:
+                first, last = map(int, span.split("-"))
+            else:
+                first = int(span)
+                last = hi if step else first
+            values.update(range(first, last + 1, int(step or 1)))
+        if not values or min(values) < lo or max(values) > hi:
+            raise ValueError(f"Cron field out of range: {field!r}")
+        return values
+
+    def _day_matches(self, dt):
+        day_ok = dt.day in self.days
+        weekday_ok = (dt.weekday() + 1) % 7 in self.weekdays
+        return (day_ok or weekday_ok) if self.day_or_weekday else (day_ok and weekday_ok)
+
+    def next_after(self, ts):
+        dt = datetime.datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        for _ in range(5000): # Skips whole months/days/hours, so this is plenty
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif dt.hour not in self.hours:
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+            elif dt.minute not in self.minutes:
+                dt += datetime.timedelta(minutes=1)
+            else:
+                return dt.timestamp()
+        raise ValueError(f"Cron never fires: {self.expr!r}")
+
+class Every:
+    """Fixed or random interval (seconds) between runs"""
+    def __init__(self, low, high=None):
+        self.low = low
+        self.high = high or low
+
+    def next_after(self, ts):
+        return ts + random.uniform(self.low, self.high)
+
+class Job:
+    def __init__(self, job_id, kind, trigger, fn, args=(), jitter=0, grace=JOB_MISFIRE_GRACE):
+        self.id = job_id
+        self.kind = kind
+        self.trigger = trigger
+        self.fn = fn
+        self.args = args
+        self.grace = grace
+        # Stable per-job offset within the jitter window
+        self.offset = int(hashlib.sha256(job_id.encode("utf-8")).hexdigest()[:8], 16) % (jitter + 1) if jitter else 0
+        self.next_run = None
+        self.last_run = None
+
+    def next_after(self, ts):
+        """Next run strictly after ts (ts is a run time, i.e. already includes the offset)"""
+        return self.trigger.next_after(ts - self.offset) + self.offset
+
+class JobScheduler:
+    def __init__(self, path=JOBS_FILE, concurrency=JOB_CONCURRENCY):
+        self.path = path
+        self.concurrency = concurrency
+        self.jobs = {}
+        self.heap = [] # (next_run, job_id); stale entries are skipped when popped
+        self.users = set()
+        self.running = set()
+        self._wake = asyncio.Event()
+        self._sem = None
+        self._task = None
+        self._tasks = set()
+        self.ran = 0
+        self.failed = 0
+        self.skipped = 0 # Still running from last time
+        self.missed = 0 # Down past the grace period
+        self.caught_up = 0
+
+    def add(self, job):
+        if job.id in self.jobs:
+            return
+        now = time.time()
+        saved = state_store.get(self.path, dict).get(job.id)
+        next_run = saved["next_run"] if saved else job.next_after(now)
+        if saved:
+            job.last_run = saved.get("last_run")
+        if next_run < now:
+            if now - next_run <= job.grace:
+                self.caught_up += 1 # Missed while the server was down: run once now
+            else:
+                self.missed += 1
+                next_run = self._next_future(job, next_run, now)
+        job.next_run = next_run
+        self.jobs[job.id] = job
+        self._save(job)
+        self._push(job)
+
+    def remove(self, job_id):
+        """Drop a job; its stale heap entry is skipped when it comes up"""
+        self.jobs.pop(job_id, None)
+        jobs = state_store.get(self.path, dict)
+        if jobs.pop(job_id, None) is not None:
+            state_store.set(self.path, jobs)
+
+    def remove_user(self, user_id):
+        for job in user_jobs(user_id):
+            self.remove(job.id)
+        self.users.discard(user_id) # Registered again on their next message
+
+    def ensure_user(self, user_id):
+        """Register a user's per-character jobs (cheap no-op once done)"""
+        if user_id in self.users:
+            return
+        self.users.add(user_id)
+        for job in user_jobs(user_id):
+            self.add(job)
+
+    def _next_future(self, job, ts, now):
+        while ts <= now:
+            ts = job.next_after(ts)
+        return ts
+
+    def _push(self, job):
+        heapq.heappush(self.heap, (job.next_run, job.id))
+        if self.heap[0][1] == job.id:
+            self._wake.set() # New earliest job: re-arm the timer
+
+    def _save(self, job):
+        jobs = state_store.get(self.path, dict)
+        jobs[job.id] = {"next_run": job.next_run, "last_run": job.last_run}
+        state_store.set(self.path, jobs)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            timeout = JOB_MAX_SLEEP
+            while self.heap:
+                run_at, job_id = self.heap[0]
+                job = self.jobs.get(job_id)
+                if job is None or job.next_run != run_at:
+                    heapq.heappop(self.heap) # Removed or rescheduled
+                    continue
+                now = time.time()
+                if run_at > now:
+                    timeout = min(run_at - now, JOB_MAX_SLEEP) # Re-check now and then (clock changes)
+                    break
+                heapq.heappop(self.heap)
+                self._fire(job, now)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _fire(self, job, now):
+        # Reschedule before running, so a crash mid-run never fires the job twice
+        job.last_run = now
+        job.next_run = self._next_future(job, job.next_run, now)
+        self._save(job)
+        self._push(job)
+        if job.id in self.running:
+            self.skipped += 1
+            return
+        self.running.add(job.id)
+        task = asyncio.create_task(self._execute(job))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, job):
         try:
-            with open(PENDING_FILE, 'r') as f: 
-                msgs = json.load(f)
-            # Clear file after reading
-            os.remove(PENDING_FILE)
-            return msgs
-        except: pass
-    return []
+            async with self._sem:
+                await job.fn(*job.args)
+            self.ran += 1
+            loop_ran(f"job_{job.kind}")
+        except Exception as e:
+            self.failed += 1
+            loop_ran(f"job_{job.kind}", ok=False)
+            log.error("Job %s failed: %s", job.id, e)
+        finally:
+            self.running.discard(job.id)
+
+    async def start(self):
+        self._sem = asyncio.Semaphore(self.concurrency)
+        for job in global_jobs():
+            self.add(job)
+        for user_id in await run_blocking(known_users):
+            self.ensure_user(user_id)
+        self._task = asyncio.create_task(self._run())
+        log.info("Job scheduler started with %d jobs", len(self.jobs))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+    def stats(self):
+        upcoming = min((j.next_run for j in self.jobs.values()), default=None)
+        return {
+            "jobs": len(self.jobs),
+            "running": len(self.running),
+            "next_in_seconds": round(upcoming - time.time(), 1) if upcoming else None,
+            "ran": self.ran,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "missed": self.missed,
+            "caught_up": self.caught_up,
+        }
+
+def user_jobs(user_id):
+    for char_id in PROACTIVE_CHARACTERS:
+        yield Job(f"checkin:{char_id}:{user_id}", "checkin", Cron(CHECKIN_CRON), send_checkin, (user_id, char_id), jitter=JOB_JITTER)
+        yield Job(f"flashback:{char_id}:{user_id}", "flashback", Cron(FLASHBACK_CRON), send_flashback, (user_id, char_id), jitter=JOB_JITTER)
+
+def global_jobs():
+    for char_id in STORY_CHARACTERS:
+        yield Job(f"story:{char_id}", "story", Every(*STORY_INTERVAL), post_story, (char_id,), grace=STORY_INTERVAL[1])
+    yield Job("content_pool", "content", Every(CONTENT_FILL_INTERVAL), content_pool.fill, grace=CONTENT_FILL_INTERVAL)
+
+job_scheduler = JobScheduler()
+
+# --- CONTENT POOL ---
+# Stories and check-ins are written ahead of time, off-peak and while no chat
+# is using Ollama, so the 9:00 wave of check-ins does not compete with live
+# replies. The pool looks at the jobs due within CONTENT_HORIZON and writes for
+# the slot each one will fire in; jobs take() ready text and generate live on a
+# miss. Flashbacks quote the user's own memories and stay live.
+CONTENT_POOL_FILE = "content_pool.json"
+
+class ContentPool:
+    """Per-character pool of {text, slot, expires} entries, persisted in the state store.
+
+    A story is written for the character's status slot (alex_schedule) and
+    expires when that block ends; a check-in is written for its date and time
+    of day and expires CONTENT_CHECKIN_TTL after it was due.
+    """
+    def __init__(self, path=CONTENT_POOL_FILE, sizes=CONTENT_POOL_SIZE):
+        self.path = path
+        self.sizes = sizes
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.expired = 0
+        self.deferred = 0 # Fill rounds cut short by peak hours or live traffic
+
+    def _prune(self, pool, now):
+        for key, entries in pool.items():
+            fresh = [e for e in entries if e["expires"] > now]
+            self.expired += len(entries) - len(fresh)
+            entries[:] = fresh
+
+    def take(self, char_id, kind, slot):
+        pool = state_store.get(self.path, dict)
+        self._prune(pool, time.time())
+        entries = pool.get(f"{char_id}:{kind}", [])
+        for i, entry in enumerate(entries):
+            if entry["slot"] == slot:
+                del entries[i]
+                state_store.set(self.path, pool)
+                self.hits += 1
+                return entry["text"]
+        self.misses += 1
+        return None
+
+    def demand(self, now):
+        """{(char_id, kind, slot): {when, expires, count}} for the jobs due before the horizon"""
+        wanted = {}
+        for job in job_scheduler.jobs.values():
+            if job.kind not in self.sizes or job.next_run > now + CONTENT_HORIZON:
+                continue
+            when = datetime.datetime.fromtimestamp(max(job.next_run, now))
+            if job.kind == "story":
+                char_id = job.args[0]
+                slot, ends = character_slot(char_id, when)
+                expires = ends.timestamp()
+            else:
+                char_id = job.args[1]
+                slot = f"{when:%Y-%m-%d}:{checkin_context(when)}"
+                expires = when.timestamp() + CONTENT_CHECKIN_TTL
+            want = wanted.setdefault((char_id, job.kind, slot), {"when": when, "expires": expires, "count": 0})
+            want["when"] = min(want["when"], when)
+            want["expires"] = max(want["expires"], expires)
+            want["count"] = min(want["count"] + 1, self.sizes[job.kind])
+        return wanted
+
+    async def fill(self):
+        """Top the pool up for upcoming jobs, one generation at a time, backing off for live traffic"""
+        now = time.time()
+        pool = state_store.get(self.path, dict)
+        self._prune(pool, now)
+        state_store.set(self.path, pool)
+        if datetime.datetime.now().hour in CONTENT_PEAK_HOURS:
+            self.deferred += 1
+            return
+        wanted = self.demand(now)
+        for (char_id, kind, slot), want in sorted(wanted.items(), key=lambda item: item[1]["when"]):
+            entries = pool.setdefault(f"{char_id}:{kind}", [])
+            missing = want["count"] - sum(1 for e in entries if e["slot"] == slot)
+            for _ in range(missing):
+                if not ollama_scheduler.idle(CONTENT_IDLE_SECONDS):
+                    self.deferred += 1
+                    return
+                if kind == "story":
+                    text = await generate_story(char_id, want["when"])
+                else:
+                    text = await generate_checkin(char_id, slot.split(":", 1)[1])
+                entries.append({"text": text, "slot": slot, "expires": want["expires"]})
+                state_store.set(self.path, pool)
+                self.generated += 1
+
+    def stats(self):
+        pool = state_store.get(self.path, dict)
+        return {
+            "ready": {key: len(entries) for key, entries in pool.items() if entries},
+            "hits": self.hits,
+            "misses": self.misses,
+            "generated": self.generated,
+            "expired": self.expired,
+            "deferred": self.deferred,
+        }
+
+content_pool = ContentPool()
+
+# --- PUSH DELIVERY (auto-messages) ---
+PENDING_FILE = "pending_messages.json"
+
+class MessageOutbox:
+    """Per-user queue of proactive messages, delivered over /events or /sync.
+
+    The queue is the user's pending_messages.json entry in the StateStore, so
+    anything not yet delivered survives a restart. Connected /events clients
+    wait on an asyncio.Event and are woken only when a message arrives;
+    idle connections cost a keep-alive comment every PUSH_KEEPALIVE seconds.
+    Messages leave the queue only when handed to a client.
+    """
+    def __init__(self):
+        self._waiters = {} # user_id -> set of asyncio.Event
+        self.pushed = 0
+        self.synced = 0
+
+    def put(self, user_id, text):
+        path = user_path(user_id, PENDING_FILE)
+        messages = state_store.get(path, list)
+        messages.append({
+            "text": text,
+            "isUser": False,
+            "timestamp": str(datetime.datetime.now())
+        })
+        state_store.set(path, messages)
+        for event in self._waiters.get(user_id, ()):
+            event.set()
+
+    async def take(self, user_id):
+        """Remove and return everything queued for the user"""
+        path = user_path(user_id, PENDING_FILE)
+        # Take and clear in one step: nothing can be appended in between
+        messages = await state_store.load(path, list)
+        if messages:
+            state_store.set(path, [])
+        return messages
+
+    def _requeue(self, user_id, messages):
+        path = user_path(user_id, PENDING_FILE)
+        state_store.set(path, messages + state_store.get(path, list))
+
+    async def subscribe(self, user_id):
+        """Yield batches of messages as they arrive (None = keep-alive tick)"""
+        event = asyncio.Event()
+        self._waiters.setdefault(user_id, set()).add(event)
+        try:
+            while True:
+                event.clear()
+                messages = await self.take(user_id)
+                if messages:
+                    try:
+                        yield messages
+                    except BaseException:
+                        # Client went away before we could hand them over
+                        self._requeue(user_id, messages)
+                        raise
+                    self.pushed += len(messages)
+                    continue
+                try:
+                    await asyncio.wait_for(event.wait(), PUSH_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            waiters = self._waiters.get(user_id)
+            waiters.discard(event)
+            if not waiters:
+                del self._waiters[user_id]
+
+    def stats(self):
+        return {
+            "subscribers": sum(len(w) for w in self._waiters.values()),
+            "pushed": self.pushed,
+            "synced": self.synced,
+        }
+
+message_outbox = MessageOutbox()
+
+def save_pending_message(text, user_id=DEFAULT_USER):
+    message_outbox.put(user_id, text)
+
+@app.get("/events")
+async def push_events(user_id: str = DEFAULT_USER):
+    """Server-Sent Events channel for auto-messages (event: message)"""
+    user_id = check_user_id(user_id)
+
+    async def stream():
+        async for messages in message_outbox.subscribe(user_id):
+            if messages is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield "".join(sse_event("message", m) for m in messages)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/sync")
+async def sync_messages(user_id: str = DEFAULT_USER):
+    """Endpoint for the frontend to poll for auto-messages (legacy clients; same queue as /events)"""
+    msgs = await message_outbox.take(check_user_id(user_id))
+    message_outbox.synced += len(msgs)
+    return msgs
+
+@app.get("/stats")
+async def get_stats():
+    """Runtime counters (cache hit rates etc.)"""
+    return {
+        "cache": {
+            "weather": weather_cache.stats(),
+            "trending": trending_cache.stats(),
+            "embeddings": memory_system.embedding_cache.stats(),
+        },
+        "memory_queue": memory_writer.stats(),
+        "state_store": state_store.stats(),
+        "push": message_outbox.stats(),
+        "jobs": job_scheduler.stats(),
+        "content_pool": content_pool.stats(),
+        "chat_stages": context_timings.stats(),
+        "vision": vision_cache.stats(),
+        "audio": audio_cache.stats(),
+        "llm": llm_usage.stats(),
+        "history": history_compactor.stats(),
+        "responses": response_cache.stats(),
+        "facts": fact_store.stats(),
+        "ollama_queue": ollama_scheduler.stats(),
+        "ollama_backends": ollama.stats(),
+    }
+
+# Gauges and counters read from the components' own stats at scrape time
+def cache_counts(field):
+    caches = {
+        "weather": weather_cache,
+        "trending": trending_cache,
+        "embeddings": memory_system.embedding_cache,
+        "vision": vision_cache,
+        "audio": audio_cache,
+        "content_pool": content_pool,
+        "responses": response_cache,
+    }
+    return [({"cache": name}, getattr(cache, field)) for name, cache in caches.items()]
+
+CallbackMetric("echo_cache_hits_total", "Cache hits", "counter", lambda: cache_counts("hits"))
+CallbackMetric("echo_cache_misses_total", "Cache misses", "counter", lambda: cache_counts("misses"))
+CallbackMetric("echo_ollama_queue_waiting", "Requests waiting for an Ollama slot", "gauge",
+               lambda: [({"priority": p}, n) for p, n in ollama_scheduler.waiting.items()])
+CallbackMetric("echo_ollama_queue_running", "Requests holding an Ollama slot", "gauge",
+               lambda: [({"priority": p}, n) for p, n in ollama_scheduler.running.items()])
+CallbackMetric("echo_ollama_queue_rejected_total", "Requests turned away with 429", "counter",
+               lambda: [({"priority": p}, n) for p, n in ollama_scheduler.rejected.items()])
+CallbackMetric("echo_ollama_backend_up", "1 if the backend passes health checks", "gauge",
+               lambda: [({"backend": b.url}, int(b.usable())) for b in ollama.backends])
+CallbackMetric("echo_ollama_backend_outstanding", "Requests in flight per backend", "gauge",
+               lambda: [({"backend": b.url}, b.outstanding) for b in ollama.backends])
+CallbackMetric("echo_memory_queue_depth", "Chat turns waiting to be written to memory", "gauge",
+               lambda: [({}, memory_writer.queue.qsize())])
+CallbackMetric("echo_response_cache_saved_seconds_total", "Ollama time saved by cached generate replies", "counter",
+               lambda: [({}, round(response_cache.saved_seconds, 3))])
+CallbackMetric("echo_fact_prefilter_total", "Messages sent to fact extraction or skipped by the pre-filter", "counter",
+               lambda: [({"result": "checked"}, fact_store.checked), ({"result": "skipped"}, fact_store.skipped)])
+CallbackMetric("echo_memory_write_lag_seconds", "Queue-to-Chroma delay of the last memory batch", "gauge",
+               lambda: [({}, round(memory_writer.last_lag, 3))])
+CallbackMetric("echo_state_dirty_entries", "State entries not yet written to disk", "gauge",
+               lambda: [({}, len(state_store._dirty))])
+CallbackMetric("echo_push_subscribers", "Open /events connections", "gauge",
+               lambda: [({}, message_outbox.stats()["subscribers"])])
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of the counters, histograms and gauges above"""
+    return Response(render_metrics(), media_type="text/plain; version=0.0.4")
 
 @app.get("/story")
-async def get_active_story():
-    if os.path.exists(STORY_FILE):
+async def get_active_story(user_id: str = DEFAULT_USER, character_id: str = "alex"):
+    check_user_id(user_id) # Stories are shared, but keep the API uniform
+    if character_id not in CHARACTERS:
+        return {}
+    data = await state_store.load(story_path(character_id), dict)
+    if data:
         try:
-            with open(STORY_FILE, 'r') as f:
-                data = json.load(f)
-                # Story expires after 24 hours
-                ts = datetime.datetime.fromisoformat(data['timestamp'])
-                if (datetime.datetime.now() - ts).total_seconds() < 86400:
-                    return data
+            # Story expires after 24 hours
+            ts = datetime.datetime.fromisoformat(data['timestamp'])
+            if (datetime.datetime.now() - ts).total_seconds() < 86400:
+                return data
         except: pass
     return {}
 
@@ -542,100 +2519,526 @@ def humanize_text(text):
             
     return " ".join(new_words)
 
-@app.post("/chat")
-async def chat_endpoint(request: ChatRequest):
+DM_INSTRUCTIONS = """
+                \nINSTRUCTIONS:
+                - TEXTING STYLE: KEEP IT SHORT. Match the user's energy. If they send 5 words, you send 5-10 words. Do NOT write paragraphs.
+                - EMOJIS: Use emojis RARELY (max 1 every 5 messages). Do not use them in every sentence.
+                - React to the current time/status.
+                - If your status says you are 'Busy' or 'Sleeping', mention it.
+                - DO NOT use [VOICE] tags.
+                - Use web search results if provided.
+                - CRITICAL: At the VERY END of your message, output your new emotional state in this format: [MOOD: Happy], [MOOD: Annoyed], [MOOD: Tired], etc. This will be hidden from the user but saved for the next conversation.
+                """
+
+def read_image_b64(img_path):
+    with open(img_path, "rb") as img_file:
+        return base64.b64encode(img_file.read()).decode('utf-8')
+
+# --- IMAGES (upload + vision cache) ---
+IMAGE_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class VisionCache:
+    """LLaVA descriptions keyed by image content hash.
+
+    Results are kept in VISION_CACHE_FILE (through the state store), so an image is
+    analyzed once no matter how often it is sent. Concurrent requests for the same
+    image share one in-flight analysis.
+    """
+    def __init__(self, path=VISION_CACHE_FILE, max_items=VISION_CACHE_MAX_ITEMS):
+        self.path = path
+        self.max_items = max_items
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+
+    def get(self, digest):
+        entry = state_store.get(self.path, dict).get(digest)
+        return entry["description"] if entry else None
+
+    def prefetch(self, digest, img_path):
+        """Start analyzing in the background (no-op if cached or already running)"""
+        if self.get(digest) is None and digest not in self.inflight:
+            self._start(digest, img_path)
+
+    async def describe(self, digest, img_path):
+        await state_store.load(self.path, dict)
+        desc = self.get(digest)
+        if desc is not None:
+            self.hits += 1
+            return desc
+        task = self.inflight.get(digest)
+        if task:
+            self.joined += 1
+        else:
+            task = self._start(digest, img_path)
+        # Shielded: if the caller gives up (context timeout), the result still lands in the cache
+        return await asyncio.shield(task)
+
+    def _start(self, digest, img_path):
+        self.misses += 1
+        task = asyncio.create_task(self._analyze(digest, img_path))
+        self.inflight[digest] = task
+        task.add_done_callback(lambda t: self._done(digest, t))
+        return task
+
+    def _done(self, digest, task):
+        self.inflight.pop(digest, None)
+        if not task.cancelled() and task.exception():
+            log.error("Vision error: %s", task.exception())
+
+    async def _analyze(self, digest, img_path):
+        # Convert image to base64 (off the event loop, photos can be large)
+        b64_data = await run_blocking(read_image_b64, img_path)
+
+        log.debug("Analyzing image with LLaVA: %s", img_path)
+        v_data = await ollama.generate({
+            "model": VISION_MODEL, # Make sure user has this!
+            "prompt": "Describe this image in detail. What is funny or interesting about it?",
+            "images": [b64_data],
+            "stream": False
+        }, timeout=60.0, priority=PRIORITY_INTERACTIVE) # The user is waiting for a reply about it
+        desc = v_data['response']
+        log.debug("Vision result: %s", desc)
+
+        cache = dict(state_store.get(self.path, dict))
+        cache[digest] = {"description": desc, "ts": time.time()}
+        if len(cache) > self.max_items:
+            # Drop the oldest descriptions
+            for old in sorted(cache, key=lambda d: cache[d]["ts"])[:len(cache) - self.max_items]:
+                del cache[old]
+        state_store.set(self.path, cache)
+        return desc
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.joined
+        return {
+            "entries": len(state_store.get(self.path, dict)),
+            "in_flight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined": self.joined,
+            "hit_rate": round((self.hits + self.joined) / lookups, 3) if lookups else None,
+        }
+
+vision_cache = VisionCache()
+
+@app.post("/upload")
+async def upload_image(file: UploadFile = File(...)):
+    """Store an image under its content hash and start describing it right away"""
+    ext = os.path.splitext(file.filename or "")[1].lower()
+    if ext not in UPLOAD_EXTENSIONS:
+        ext = ".jpg"
+    tmp_path = os.path.join(IMAGE_DIR, f".upload-{uuid.uuid4().hex}")
+    h = hashlib.sha256()
+    size = 0
     try:
-        final_prompt = request.message
-        thread_id = request.thread_id or "dm"
-        char_id = request.character_id or "alex"
-        char_config = CHARACTERS.get(char_id, CHARACTERS["alex"])
-        
-        # --- GROUP CHAT LOGIC (SARAH) ---
-        sarah_mode = False
-        if thread_id == "group":
-            sarah_mode = True
-
-        # --- RETRIEVE CONTEXT ---
-        alex_status = get_alex_status() # Keep for time/weather context
-        state = get_character_state(char_id)
-        profile = get_user_profile()
-        
-        current_mood = state.get("mood", "Chill")
-        
-        # 1. VISION ENGINE (Eyes)
-        image_context = ""
-        if request.image_filename:
+        with open(tmp_path, "wb") as out:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="Image too large")
+                h.update(chunk)
+                await run_blocking(out.write, chunk)
+        digest = h.hexdigest()
+        filename = digest + ext
+        img_path = os.path.join(IMAGE_DIR, filename)
+        if os.path.exists(img_path):
+            os.remove(tmp_path) # Same image uploaded before
+        else:
+            os.replace(tmp_path, img_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    vision_cache.prefetch(digest, img_path)
+    return {"filename": filename, "url": f"/images/{filename}"}
+
+# --- TEXT TO SPEECH ---
+class TTSEngine(ABC):
+    """Speech backend: stream(text, voice) yields MP3 bytes as they are produced"""
+    name = "base"
+
+    @abstractmethod
+    def stream(self, text, voice):
+        """Async iterator of MP3 chunks"""
+
+class EdgeTTS(TTSEngine):
+    """Microsoft Edge online voices (needs network)"""
+    name = "edge"
+
+    async def stream(self, text, voice):
+        communicate = edge_tts.Communicate(text, voice)
+        async for chunk in communicate.stream():
+            if chunk["type"] == "audio":
+                yield chunk["data"]
+
+class SilentTTS(TTSEngine):
+    """Offline stand-in: silent MP3 frames, about as long as reading the text aloud"""
+    name = "silent"
+    FRAME = bytes.fromhex("fffb9064") + bytes(413) # MPEG-1 Layer III, 128 kbps, 44.1 kHz, ~26 ms
+
+    async def stream(self, text, voice):
+        frames = max(1, int(len(text) * 0.06 / 0.026))
+        yield self.FRAME * frames
+
+TTS_ENGINES = {"edge": EdgeTTS, "silent": SilentTTS}
+tts_engine = TTS_ENGINES[TTS_ENGINE]()
+
+AUDIO_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+def concat_files(paths, dest):
+    tmp = f"{dest}.{uuid.uuid4().hex}.part"
+    with open(tmp, "wb") as out:
+        for path in paths:
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(tmp, dest)
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+class AudioCache:
+    """Synthesized speech in AUDIO_DIR, one MP3 per (engine, voice, text) hash.
+
+    Repeated phrases reuse the file; prune() keeps the directory within
+    AUDIO_CACHE_MAX_AGE / AUDIO_CACHE_MAX_BYTES (least recently used go first).
+    """
+    def __init__(self, directory=AUDIO_DIR, engine=tts_engine):
+        self.directory = directory
+        self.engine = engine
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    def key(self, text, voice):
+        return hashlib.sha256(f"{self.engine.name}\0{voice}\0{text}".encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.mp3")
+
+    async def sentence(self, text, voice):
+        """Path of the MP3 for one sentence, synthesizing it if needed"""
+        key = self.key(text, voice)
+        path = self.path(key)
+        if os.path.exists(path):
+            self.hits += 1
+            await run_blocking(os.utime, path) # Keep it fresh for pruning
+            return path
+        task = self.inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(self._synthesize(text, voice, path))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self.inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _synthesize(self, text, voice, path):
+        tmp = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(tmp, "wb") as out:
+                async for data in self.engine.stream(text, voice):
+                    await run_blocking(out.write, data)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return path
+
+    def prune(self, max_bytes=AUDIO_CACHE_MAX_BYTES, max_age=AUDIO_CACHE_MAX_AGE):
+        """Blocking: delete expired files, then the least recently used until under max_bytes"""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or entry.name.endswith(".part"):
+                continue
+            st = entry.stat()
+            files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime < max_age and total <= max_bytes:
+                break
             try:
-                # We need the full path to the image
-                # Assuming image_filename is relative to IMAGE_DIR or just the filename
-                # If the client sent just the filename from the upload response
-                img_path = os.path.join(IMAGE_DIR, request.image_filename)
-                
-                # Check if file exists, if not, try stripping leading slash
-                if not os.path.exists(img_path):
-                     img_path = os.path.join(IMAGE_DIR, request.image_filename.lstrip("/images/"))
-
-                if os.path.exists(img_path):
-                    # Convert image to base64
-                    import base64
-                    with open(img_path, "rb") as img_file:
-                        b64_data = base64.b64encode(img_file.read()).decode('utf-8')
-                    
-                    print(f"Analyzing image with LLaVA: {img_path}")
-                    async with httpx.AsyncClient(timeout=60.0) as client:
-                        v_resp = await client.post(OLLAMA_GENERATE_URL, json={
-                            "model": "llava", # Make sure user has this!
-                            "prompt": "Describe this image in detail. What is funny or interesting about it?",
-                            "images": [b64_data],
-                            "stream": False
-                        })
-                        if v_resp.status_code == 200:
-                            desc = v_resp.json()['response']
-                            image_context = f"\n[USER SENT AN IMAGE. VISUAL DESCRIPTION: {desc}]"
-                            print(f"Vision Result: {desc}")
-            except Exception as e:
-                print(f"Vision Error: {e}")
-                image_context = "\n[User sent an image but I couldn't see it clearly]"
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        self.pruned += removed
+        return removed
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            "in_flight": len(self.inflight),
+            "pruned": self.pruned,
+        }
+
+audio_cache = AudioCache()
+
+class VoiceReply:
+    """One voice message being synthesized sentence by sentence"""
+    def __init__(self, reply_id, sentences, voice):
+        self.reply_id = reply_id
+        self.sentences = sentences
+        self.voice = voice
+        loop = asyncio.get_running_loop()
+        self.parts = [loop.create_future() for _ in sentences] # Path per sentence, None on failure
 
-        # 2. ACTIVE MEMORY (Episodic)
-        # Search for past memories relevant to the current message
-        memory_context = ""
+    async def run(self):
+        paths = []
         try:
-            mems = await memory_system.search(final_prompt, top_k=2)
-            if mems:
-                 # Flatten list if needed
-                flat_mems = [item for sublist in mems for item in sublist] if isinstance(mems[0], list) else mems
-                if flat_mems:
-                    joined_mems = "\n".join([f"- {m}" for m in flat_mems])
-                    memory_context = f"\nRELEVANT MEMORIES:\n{joined_mems}"
+            for part, text in zip(self.parts, self.sentences):
+                path = await audio_cache.sentence(text, self.voice)
+                part.set_result(path)
+                paths.append(path)
+            # Stitch the whole reply into one file so the URL keeps working later
+            await run_blocking(concat_files, paths, audio_cache.path(self.reply_id))
         except Exception as e:
-            print(f"Memory Search Error: {e}")
+            log.error("TTS error: %s", e)
+        finally:
+            for part in self.parts:
+                if not part.done():
+                    part.set_result(None)
 
-        # User Facts
-        facts_list = "\n".join([f"- {f}" for f in profile["facts"]])
-        user_context = f"\nKNOWN FACTS ABOUT USER:\n{facts_list}" if profile["facts"] else ""
-        
-        # Time Gap Logic
-        last_seen_str = state.get("last_seen", str(datetime.datetime.now()))
+    async def audio(self):
+        for part in self.parts:
+            path = await part
+            if path is None:
+                break
+            try:
+                yield await run_blocking(read_bytes, path)
+            except OSError:
+                break
+
+class VoiceReplies:
+    """Turns a reply into an audio URL that is playable once the first sentence is ready"""
+    def __init__(self):
+        self.active = {}
+
+    async def start(self, text, voice):
+        """Audio URL for the reply, or None if speech failed (the reply goes out as text)"""
         try:
-            last_seen = datetime.datetime.fromisoformat(last_seen_str)
-        except:
-            last_seen = datetime.datetime.now()
-        
-        time_diff = datetime.datetime.now() - last_seen
-        gap_context = ""
-        if time_diff.total_seconds() > 86400: # 24 hours
-            gap_context = "\n[CONTEXT: You haven't spoken to the user in over 24 hours.]"
-
-        # Random Events
-        event_context = ""
-        if random.random() < 0.05:
-            event = random.choice(RANDOM_EVENTS)
-            event_context = f"\n[EVENT HAPPENING NOW: {event}. React to this naturally!]"
-        
-        # Inject System Prompt
-        base_instruction = f"""
-{char_config['prompt_base']}
+            return await self._start(text, voice)
+        except Exception as e:
+            log.error("Voice reply failed: %s", e)
+            return None
+
+    async def _start(self, text, voice):
+        sentences = [s for s in SENTENCE_END.split(text) if s.strip()] or [text]
+        if len(sentences) == 1:
+            path = await audio_cache.sentence(sentences[0], voice)
+            return f"/audio/{os.path.basename(path)}"
+
+        reply_id = audio_cache.key(text, voice)
+        if os.path.exists(audio_cache.path(reply_id)):
+            audio_cache.hits += 1
+            return f"/audio/{reply_id}.mp3"
+
+        reply = self.active.get(reply_id)
+        if reply is None:
+            reply = VoiceReply(reply_id, sentences, voice)
+            self.active[reply_id] = reply
+            reply.task = asyncio.create_task(reply.run())
+            reply.task.add_done_callback(lambda t: self.active.pop(reply_id, None))
+        if await asyncio.shield(reply.parts[0]) is None:
+            return None
+        return f"/voice/{reply_id}"
+
+voice_replies = VoiceReplies()
+
+async def audio_prune_loop():
+    while True:
+        try:
+            removed = await run_blocking(audio_cache.prune)
+            if removed:
+                log.info("Pruned %d audio files", removed)
+            loop_ran("audio_prune")
+        except Exception as e:
+            log.error("Audio prune error: %s", e)
+            loop_ran("audio_prune", ok=False)
+        await asyncio.sleep(AUDIO_PRUNE_INTERVAL)
+
+@app.get("/voice/{reply_id}")
+async def stream_voice(reply_id: str):
+    """Audio for a voice reply; streams sentences while the rest is still being synthesized"""
+    if not AUDIO_ID_PATTERN.match(reply_id):
+        raise HTTPException(status_code=404, detail="Not found")
+    reply = voice_replies.active.get(reply_id)
+    if reply is None:
+        path = audio_cache.path(reply_id)
+        if not os.path.exists(path):
+            raise HTTPException(status_code=404, detail="Not found")
+        return FileResponse(path, media_type="audio/mpeg")
+    return StreamingResponse(reply.audio(), media_type="audio/mpeg")
+
+# --- CONTEXT ASSEMBLY ---
+class StageTimings:
+    """Per-stage latency counters (count / total / max, plus timeouts and errors)"""
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, stage, seconds, outcome="ok"):
+        CHAT_STAGE_SECONDS.observe(seconds, stage=stage)
+        s = self.stages.setdefault(stage, {"count": 0, "total": 0.0, "max": 0.0, "timeouts": 0, "errors": 0})
+        s["count"] += 1
+        s["total"] += seconds
+        s["max"] = max(s["max"], seconds)
+        if outcome == "timeout": s["timeouts"] += 1
+        if outcome == "error": s["errors"] += 1
+
+    def stats(self):
+        return {
+            stage: {
+                "count": s["count"],
+                "avg_ms": round(s["total"] / s["count"] * 1000, 1),
+                "max_ms": round(s["max"] * 1000, 1),
+                "timeouts": s["timeouts"],
+                "errors": s["errors"],
+            }
+            for stage, s in self.stages.items()
+        }
+
+context_timings = StageTimings()
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    """Record how long a chat stage (llm, tts, ...) took, like the context sources"""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        context_timings.record(stage, time.perf_counter() - start, outcome)
+
+async def gather_context(sources):
+    """Await {name: (coroutine, fallback)} concurrently, each bounded by CONTEXT_TIMEOUTS[name].
+
+    Returns ({name: value or fallback}, {name: milliseconds}).
+    """
+    timings = {}
+
+    async def run(name, coro, fallback):
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await asyncio.wait_for(coro, CONTEXT_TIMEOUTS.get(name, CONTEXT_DEFAULT_TIMEOUT))
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            log.warning("Context source %s timed out, skipping it", name)
+            return fallback
+        except Exception as e:
+            outcome = "error"
+            log.warning("Context source %s failed: %s", name, e)
+            return fallback
+        finally:
+            elapsed = time.perf_counter() - start
+            timings[name] = round(elapsed * 1000, 1)
+            context_timings.record(name, elapsed, outcome)
+
+    names = list(sources)
+    values = await asyncio.gather(*(run(n, *sources[n]) for n in names))
+    return dict(zip(names, values)), timings
+
+async def load_turn_state(char_id, user_id):
+    state, profile, _ = await asyncio.gather(
+        get_character_state(char_id, user_id),
+        get_user_profile(user_id),
+        state_store.load(user_path(user_id, SUMMARY_FILE), dict), # Read by history_compactor.window later this turn
+    )
+    return state, profile
+
+async def describe_image(image_filename):
+    # 1. VISION ENGINE (Eyes)
+    # Clients send either the filename or the url from /upload ("/images/<sha256>.<ext>");
+    # only that form is accepted, which also keeps the path inside IMAGE_DIR
+    name = os.path.basename(image_filename)
+    digest, ext = os.path.splitext(name)
+    if not IMAGE_HASH_PATTERN.match(digest) or ext not in UPLOAD_EXTENSIONS:
+        log.warning("Ignoring image with unexpected name: %s", image_filename)
+        return ""
+
+    img_path = os.path.join(IMAGE_DIR, name)
+    if not os.path.exists(img_path):
+        return ""
+
+    desc = await vision_cache.describe(digest, img_path)
+    return f"\n[USER SENT AN IMAGE. VISUAL DESCRIPTION: {desc}]"
+
+async def recall_memories(query, char_id, user_id, thread_id):
+    # 2. ACTIVE MEMORY (Episodic)
+    # Search for past memories relevant to the current message
+    since = time.time() - MEMORY_SEARCH_DAYS * 86400 if MEMORY_SEARCH_DAYS else None
+    mems = await memory_system.search(query, character_id=char_id, user_id=user_id, thread_id=thread_id, since=since, top_k=2)
+    if mems:
+        # Flatten list if needed
+        flat_mems = [item for sublist in mems for item in sublist] if isinstance(mems[0], list) else mems
+        if flat_mems:
+            joined_mems = "\n".join([f"- {m}" for m in flat_mems])
+            return f"\nRELEVANT MEMORIES:\n{joined_mems}"
+    return ""
+
+async def build_chat_context(request: ChatRequest):
+    """Gather everything the system prompt needs for one chat turn"""
+    final_prompt = request.message
+    thread_id = request.thread_id or "dm"
+    char_id = request.character_id if request.character_id in CHARACTERS else "alex" # Also names Chroma collections and state files
+    user_id = check_user_id(request.user_id)
+    char_config = CHARACTERS[char_id]
+    job_scheduler.ensure_user(user_id) # New users get their check-in/flashback jobs (DM or group)
+
+    # --- RETRIEVE CONTEXT ---
+    # Independent sources run side by side; a slow or failing one is dropped
+    # (fallback text) instead of holding up the reply.
+    sources = {
+        "status": (get_alex_status(), ""), # Keep for time/weather context
+        "state": (load_turn_state(char_id, user_id), ({"mood": "Chill"}, {"facts": []})),
+        "memory": (recall_memories(final_prompt, char_id, user_id, thread_id), ""),
+    }
+    if request.image_filename:
+        sources["vision"] = (describe_image(request.image_filename), "\n[User sent an image but I couldn't see it clearly]")
+    results, timings = await gather_context(sources)
+    alex_status = results["status"]
+    state, profile = results["state"]
+    memory_context = results["memory"]
+    image_context = results.get("vision", "")
+
+    current_mood = state.get("mood", "Chill")
+
+    # User Facts
+    facts = fact_store.select(profile, final_prompt)
+    facts_list = "\n".join([f"- {f}" for f in facts])
+    user_context = f"\nKNOWN FACTS ABOUT USER:\n{facts_list}" if facts else ""
+
+    # Time Gap Logic
+    last_seen_str = state.get("last_seen", str(datetime.datetime.now()))
+    try:
+        last_seen = datetime.datetime.fromisoformat(last_seen_str)
+    except:
+        last_seen = datetime.datetime.now()
+
+    time_diff = datetime.datetime.now() - last_seen
+    gap_context = ""
+    if time_diff.total_seconds() > 86400: # 24 hours
+        gap_context = "\n[CONTEXT: You haven't spoken to the user in over 24 hours.]"
+
+    # Random Events
+    event_context = ""
+    if random.random() < 0.05:
+        event = random.choice(RANDOM_EVENTS)
+        event_context = f"\n[EVENT HAPPENING NOW: {event}. React to this naturally!]"
+
+    # Inject System Prompt (persona stays byte-identical between turns, see PROMPT ASSEMBLY)
+    live_context = f"""
 {alex_status}
 CURRENT MOOD: {current_mood}
 {user_context}
@@ -644,90 +3047,278 @@ CURRENT MOOD: {current_mood}
 {event_context}
 {image_context}
 """
+    return {
+        "char_id": char_id,
+        "user_id": user_id,
+        "char_config": char_config,
+        "thread_id": thread_id,
+        "state": state,
+        "current_mood": current_mood,
+        "persona": char_config['prompt_base'],
+        "live_context": live_context,
+        "sarah_mode": thread_id == "group", # --- GROUP CHAT LOGIC (SARAH) ---
+        "timings": timings,
+    }
 
-        if sarah_mode:
-            # --- SPLIT BRAIN STRATEGY ---
-            # 1. Alex Reacts
-            sys_alex = {
-                "role": "system",
-                "content": base_instruction + "\nCONTEXT: You are in a group chat with Sarah and the user. Sarah is about to speak too. Reply to the user briefly."
-            }
-            msgs_alex = [sys_alex] + request.history + [{"role": "user", "content": final_prompt}]
-            
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                resp_alex = await client.post(OLLAMA_URL, json={"model": MAIN_MODEL, "messages": msgs_alex, "stream": False})
-                alex_text = resp_alex.json()['message']['content']
-                
-                # 2. Sarah Reacts (Seeing Alex's message)
-                sys_sarah = {
-                    "role": "system",
-                    "content": f"""
-                    Your name is Sarah. You are the user's chaotic best friend.
-                    PERSONALITY: Loud, fun, uses emojis, bad slang, supports the user but roasts Alex.
-                    CONTEXT: Group chat with Alex and User.
-                    Alex just said: "{alex_text}"
-                    Reply to the conversation.
-                    """
-                }
-                # Sarah only needs recent context
-                msgs_sarah = [{"role": "system", "content": sys_sarah["content"]}, {"role": "user", "content": final_prompt}]
-                
-                resp_sarah = await client.post(OLLAMA_URL, json={"model": MAIN_MODEL, "messages": msgs_sarah, "stream": False})
-                sarah_text = resp_sarah.json()['message']['content']
-                
-                return {"group_messages": [
-                    {"sender": "Alex", "text": alex_text},
-                    {"sender": "Sarah", "text": sarah_text}
-                ]}
+# --- HISTORY WINDOW ---
+# The client sends the whole conversation every turn. Only the newest turns that
+# fit the model's token budget go to Ollama verbatim; older ones are folded into
+# a rolling summary that is updated in the background (the reply never waits
+# for it). Details beyond both still reach the prompt through memory recall.
+SUMMARY_FILE = "history_summaries.json"
 
-        else:
-            system_instruction = {
-                "role": "system",
-                "content": base_instruction + """
-                \nINSTRUCTIONS:
-                - TEXTING STYLE: KEEP IT SHORT. Match the user's energy. If they send 5 words, you send 5-10 words. Do NOT write paragraphs.
-                - EMOJIS: Use emojis RARELY (max 1 every 5 messages). Do not use them in every sentence.
-                - React to the current time/status.
-                - If your status says you are 'Busy' or 'Sleeping', mention it.
-                - DO NOT use [VOICE] tags.
-                - Use web search results if provided.
-                - CRITICAL: At the VERY END of your message, output your new emotional state in this format: [MOOD: Happy], [MOOD: Annoyed], [MOOD: Tired], etc. This will be hidden from the user but saved for the next conversation.
-                """
-            }
-        
-            messages = [system_instruction] + request.history + [{"role": "user", "content": final_prompt}]
+def estimate_tokens(text):
+    return len(text or "") // 4 + 4 # ~4 characters per token plus per-message overhead
+
+def context_budget(model=MAIN_MODEL):
+    return MODEL_CONTEXT_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET)
+
+class HistoryCompactor:
+    def __init__(self):
+        self.inflight = {}
+        self.windowed = 0
+        self.summaries_written = 0
+
+    def fingerprint(self, turns):
+        return hashlib.sha256(json.dumps(turns, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+    def cut(self, history, budget):
+        """Number of oldest turns that do not fit the budget"""
+        used = kept = 0
+        for turn in reversed(history):
+            tokens = estimate_tokens(turn.get("content"))
+            if used + tokens > budget and kept >= HISTORY_MIN_TURNS:
+                break
+            used += tokens
+            kept += 1
+        cut = len(history) - kept
+        if cut == 0:
+            return 0
+        # Move the window in steps, so the verbatim part (and Ollama's cached prefix) stays put for a few turns
+        stepped = -(-cut // HISTORY_WINDOW_STEP) * HISTORY_WINDOW_STEP
+        return max(cut, min(stepped, len(history) - HISTORY_MIN_TURNS))
+
+    def window(self, ctx, history, persona, live_context, message, model=MAIN_MODEL):
+        """History to send: [summary system message] + the most recent turns"""
+        fixed = sum(estimate_tokens(t) for t in (persona, live_context, message))
+        cut = self.cut(history, context_budget(model) - fixed - HISTORY_REPLY_TOKENS)
+        if cut == 0:
+            return list(history)
+        self.windowed += 1
+
+        path = user_path(ctx["user_id"], SUMMARY_FILE)
+        key = f"{ctx['char_id']}:{ctx['thread_id']}"
+        entry = state_store.get(path, dict).get(key)
+        if entry and (entry["turns"] > len(history) or entry["fingerprint"] != self.fingerprint(history[:entry["turns"]])):
+            entry = None # Summary of a different conversation (cleared or edited on the client)
+        covered = entry["turns"] if entry else 0
+        if cut > covered:
+            self.schedule(ctx["user_id"], key, history[:cut], entry)
+
+        recent = history[max(cut, covered):]
+        if not entry:
+            return recent
+        return [{"role": "system", "content": f"EARLIER IN THIS CONVERSATION (summary):\n{entry['summary']}"}] + recent
+
+    def schedule(self, user_id, key, turns, entry):
+        job = (user_id, key)
+        if job in self.inflight:
+            return
+        task = asyncio.create_task(self._summarize(user_id, key, turns, entry))
+        self.inflight[job] = task
+        task.add_done_callback(lambda t: self.inflight.pop(job, None))
+
+    async def _summarize(self, user_id, key, turns, entry):
+        path = user_path(user_id, SUMMARY_FILE)
+        summary = entry["summary"] if entry else ""
+        covered = entry["turns"] if entry else 0
+        try:
+            while covered < len(turns):
+                chunk = turns[covered:covered + HISTORY_SUMMARY_CHUNK]
+                transcript = "\n".join(f"{t.get('role', 'user')}: {t.get('content', '')}" for t in chunk)
+                prompt = f"""Summary of the chat so far:
+{summary or "(nothing yet)"}
+
+New messages:
+{transcript}
+
+Update the summary with the new messages. Keep names, facts about the user, plans and unresolved topics.
+At most {HISTORY_SUMMARY_WORDS} words. Output only the summary."""
+                data = await ollama.generate({
+                    "model": MAIN_MODEL,
+                    "prompt": prompt,
+                    "stream": False,
+                    "keep_alive": OLLAMA_KEEP_ALIVE,
+                }, user_id=user_id)
+                summary = (data.get("response") or "").strip()
+                if not summary:
+                    return
+                covered += len(chunk)
+                async with state_store.lock(path):
+                    summaries = dict(state_store.get(path, dict))
+                    summaries[key] = {
+                        "summary": summary,
+                        "turns": covered,
+                        "fingerprint": self.fingerprint(turns[:covered]),
+                        "ts": time.time(),
+                    }
+                    state_store.set(path, summaries)
+                self.summaries_written += 1
+        except Exception as e:
+            log.error("History summary error: %s", e)
 
-            # --- CHAT LOGIC (SINGLE) ---
-            payload = {
-                "model": MAIN_MODEL,
-                "messages": messages,
-                "stream": False
+    def stats(self):
+        return {"windowed_turns": self.windowed, "summaries_written": self.summaries_written, "in_flight": len(self.inflight)}
+
+history_compactor = HistoryCompactor()
+
+# --- PROMPT ASSEMBLY ---
+# Ollama reuses its KV cache for the longest unchanged prompt prefix. The static
+# persona (and instructions) therefore come first, then the history, and only
+# then the per-turn context (time, weather, news, mood, memories, events), so
+# a new turn only has to evaluate the tail of the prompt.
+def build_prompt_messages(persona, history, live_context, message):
+    messages = [{"role": "system", "content": persona}] + history
+    if live_context.strip():
+        messages.append({"role": "system", "content": live_context})
+    return messages + [{"role": "user", "content": message}]
+
+def build_dm_messages(request: ChatRequest, ctx):
+    persona = ctx["persona"] + DM_INSTRUCTIONS
+    history = history_compactor.window(ctx, request.history, persona, ctx["live_context"], request.message)
+    return build_prompt_messages(persona, history, ctx["live_context"], request.message)
+
+def chat_payload(char_config, messages, stream):
+    """/api/chat request with the character's keep_alive and model options"""
+    return {
+        "model": MAIN_MODEL,
+        "messages": messages,
+        "stream": stream,
+        "keep_alive": char_config.get("keep_alive", OLLAMA_KEEP_ALIVE),
+        "options": {**OLLAMA_CHAT_OPTIONS, **char_config.get("options", {})},
+    }
+
+class LLMUsage:
+    """Per-character token counts and timings from Ollama's final response chunk.
+
+    prompt_eval_count only covers tokens Ollama had to evaluate, so it drops
+    when the prompt prefix is reused from the KV cache.
+    """
+    FIELDS = ("prompt_eval_count", "eval_count", "prompt_eval_duration", "eval_duration", "load_duration")
+
+    def __init__(self):
+        self.by_char = {}
+
+    def record(self, char_id, data, ttft=None):
+        if "eval_count" not in data:
+            return
+        s = self.by_char.setdefault(char_id, {"turns": 0, "ttft_turns": 0, "ttft": 0.0, **{f: 0 for f in self.FIELDS}})
+        s["turns"] += 1
+        for f in self.FIELDS:
+            s[f] += data.get(f, 0) or 0
+        if ttft is not None:
+            s["ttft_turns"] += 1
+            s["ttft"] += ttft
+        for kind in ("prompt_eval", "eval"):
+            OLLAMA_TOKENS.inc(data.get(f"{kind}_count", 0) or 0, character=char_id, kind=kind)
+            OLLAMA_TOKEN_SECONDS.inc((data.get(f"{kind}_duration", 0) or 0) / 1e9, character=char_id, kind=kind)
+        if ttft is not None:
+            OLLAMA_FIRST_TOKEN_SECONDS.observe(ttft, character=char_id)
+        log.debug("LLM usage (%s): prompt %s tok / %.0f ms, eval %s tok / %.0f ms, first token %s ms", char_id,
+                  data.get("prompt_eval_count", 0), (data.get("prompt_eval_duration", 0) or 0) / 1e6,
+                  data.get("eval_count", 0), (data.get("eval_duration", 0) or 0) / 1e6,
+                  f"{ttft * 1000:.0f}" if ttft is not None else "-")
+
+    def stats(self):
+        out = {}
+        for char_id, s in self.by_char.items():
+            n = s["turns"]
+            out[char_id] = {
+                "turns": n,
+                "avg_prompt_tokens": round(s["prompt_eval_count"] / n, 1),
+                "avg_eval_tokens": round(s["eval_count"] / n, 1),
+                "avg_prompt_eval_ms": round(s["prompt_eval_duration"] / n / 1e6, 1),
+                "avg_eval_ms": round(s["eval_duration"] / n / 1e6, 1),
+                "avg_load_ms": round(s["load_duration"] / n / 1e6, 1),
+                "avg_first_token_ms": round(s["ttft"] / s["ttft_turns"] * 1000, 1) if s["ttft_turns"] else None,
             }
-            
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                resp = await client.post(OLLAMA_URL, json=payload)
-                resp.raise_for_status()
-                data = resp.json()
-                print(f"RAW OLLAMA RESPONSE: {data}") # Debugging
-                ai_text = data.get('message', {}).get('content', "") or ""
+        return out
+
+llm_usage = LLMUsage()
+
+def parse_mood(text, current_mood):
+    """Strip the trailing [MOOD: ...] tag, returning (visible_text, mood)"""
+    if "[MOOD:" in text:
+        try:
+            # Extract mood like [MOOD: Happy]
+            parts = text.split("[MOOD:")
+            return parts[0].strip(), parts[1].split("]")[0].strip()
+        except: pass
+    return text, current_mood
+
+async def save_turn_state(char_id, user_id, new_mood):
+    async with character_state_lock(char_id, user_id):
+        # Re-read: another turn may have updated the state while we generated
+        state = await get_character_state(char_id, user_id)
+        state["mood"] = new_mood
+        state["last_seen"] = str(datetime.datetime.now())
+        save_character_state(char_id, state, user_id)
+
+def remember_turn(request: ChatRequest, ctx):
+    # Episodic memory + fact extraction happen in the background (MemoryWriter)
+    memory_writer.enqueue(request.message, {
+        "role": "user",
+        "character_id": ctx["char_id"],
+        "thread_id": ctx["thread_id"],
+        "user_id": ctx["user_id"],
+    })
+
+def typing_delay(part):
+    # Calculate typing delay: ~0.05s per character
+    delay = len(part) * 0.05
+    if delay < 1.0: delay = 1.0
+    if delay > 4.0: delay = 4.0
+    return delay
+
+def busy_error(e):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(OLLAMA_BUSY_RETRY_AFTER)})
+
+@app.post("/chat")
+async def chat_endpoint(request: ChatRequest):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        ollama_scheduler.check(user_id=check_user_id(request.user_id)) # Turn the request away early if replies are already backed up
+        ctx = await build_chat_context(request)
+        char_id = ctx["char_id"]
+        char_config = ctx["char_config"]
+        current_mood = ctx["current_mood"]
+
+        if ctx["sarah_mode"]:
+            with timed_stage("llm"):
+                group_messages = await generate_group_replies(request, ctx)
+            remember_turn(request, ctx)
+            outcome = "ok"
+            return {"group_messages": group_messages}
+
+        # --- CHAT LOGIC (SINGLE) ---
+        payload = chat_payload(char_config, build_dm_messages(request, ctx), stream=False)
+
+        with timed_stage("llm"):
+            data = await ollama.post(OLLAMA_CHAT_PATH, payload, priority=PRIORITY_INTERACTIVE, user_id=ctx["user_id"])
+        llm_usage.record(char_id, data)
+        ai_text = data.get('message', {}).get('content', "") or ""
 
         # --- STATE UPDATE (MOOD PARSING) ---
-        new_mood = current_mood
-        if "[MOOD:" in ai_text:
-            try:
-                # Extract mood like [MOOD: Happy]
-                parts = ai_text.split("[MOOD:")
-                new_mood = parts[1].split("]")[0].strip()
-                ai_text = parts[0].strip() # Remove the tag from the user's view
-            except: pass
-            
+        ai_text, new_mood = parse_mood(ai_text, current_mood) # Remove the tag from the user's view
+        spoken_text = ai_text.replace("[VOICE]", "").strip() # Speech gets the text without typos (and caches better)
+
         # Apply Humanizer (Typos, Lowercase) AFTER stripping tags
         ai_text = humanize_text(ai_text)
-            
+
         # Save state
-        state["mood"] = new_mood
-        state["last_seen"] = str(datetime.datetime.now())
-        save_character_state(char_id, state)
+        await save_turn_state(char_id, ctx["user_id"], new_mood)
+        remember_turn(request, ctx)
 
         # --- DYNAMIC VOICE LOGIC ---
         audio_url = None
@@ -736,77 +3327,311 @@ CURRENT MOOD: {current_mood}
         if "[VOICE]" in ai_text:
             is_voice_only = True
             clean_text = ai_text.replace("[VOICE]", "").strip()
-            
-            filename = f"{uuid.uuid4()}.mp3"
-            filepath = os.path.join(AUDIO_DIR, filename)
-            communicate = edge_tts.Communicate(clean_text, char_config.get("voice", VOICE))
-            await communicate.save(filepath)
-            audio_url = f"/audio/{filename}"
+
+            with timed_stage("tts"):
+                audio_url = await voice_replies.start(spoken_text, char_config.get("voice", VOICE))
+            is_voice_only = audio_url is not None # No audio: show the text instead
             ai_text = clean_text
 
         # --- DOUBLE TEXTING LOGIC ---
         # Split text into multiple bubbles if natural
         response_messages = []
-        
+
         # Simple heuristic: Split by newline or sentence ending if long enough
-        import re
         # Split by .?! but keep the punctuation
         parts = re.split(r'(?<=[.?!])\s+', ai_text)
-        
+
         final_parts = []
         current_part = ""
-        
+
         for p in parts:
-            if len(current_part) + len(p) < 60: # Group short sentences
+            if len(current_part) + len(p) < BUBBLE_MIN_CHARS: # Group short sentences
                 current_part += " " + p if current_part else p
             else:
                 if current_part: final_parts.append(current_part)
                 current_part = p
         if current_part: final_parts.append(current_part)
-        
+
         # Random chance to send as one block anyway (don't always double text)
         if random.random() < 0.3 or is_voice_only:
             final_parts = [ai_text]
-            
+
         for part in final_parts:
-            # Calculate typing delay: ~0.05s per character
-            delay = len(part) * 0.05
-            if delay < 1.0: delay = 1.0
-            if delay > 4.0: delay = 4.0
-            
             response_messages.append({
                 "text": part.strip(),
                 "audio_url": audio_url if part == final_parts[-1] else None, # Only attach audio to last
                 "is_voice_only": is_voice_only,
-                "typing_delay": delay
+                "typing_delay": typing_delay(part)
             })
 
+        outcome = "ok"
         return {
             "text": ai_text, # Fallback for legacy frontends
             "messages": response_messages
         }
 
+    except HTTPException:
+        raise
+    except OllamaBusy as e:
+        outcome = "busy"
+        raise busy_error(e)
     except Exception as e:
-        print(f"Error: {e}")
+        log.exception("Chat error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        CHAT_REQUESTS.inc(endpoint="/chat", outcome=outcome)
+        CHAT_SECONDS.observe(time.perf_counter() - started, endpoint="/chat")
+
+# --- STREAMING CHAT (SSE) ---
+# /chat/stream forwards Ollama's token stream and pushes each bubble as soon as
+# its sentence is complete, so the user sees the first words after
+# time-to-first-token instead of after the whole completion.
+MOOD_TAG = "[MOOD:"
+BUBBLE_MIN_CHARS = 60
+SENTENCE_END = re.compile(r'(?<=[.?!])\s+')
+
+class BubbleStream:
+    """Turns streamed tokens into chat bubbles, hiding the trailing [MOOD: ...] tag"""
+    def __init__(self):
+        self.text = ""      # raw model output so far
+        self.emitted = 0    # chars of visible text already consumed into bubbles
+        self.pending = ""   # complete sentences waiting to fill a bubble
+        self.bubbles = 0    # bubbles emitted so far
+
+    def visible(self, final=False):
+        cut = self.text.find(MOOD_TAG)
+        if cut != -1:
+            return self.text[:cut]
+        if not final:
+            # Hold back a tag that is still arriving ("[", "[MO", ...)
+            for i in range(len(MOOD_TAG) - 1, 0, -1):
+                if self.text.endswith(MOOD_TAG[:i]):
+                    return self.text[:-i]
+        return self.text
+
+    def _group(self, sentences, final=False):
+        bubbles = []
+        for s in sentences:
+            s = s.strip()
+            if not s: continue
+            self.pending = self.pending + " " + s if self.pending else s
+            # The first sentence goes out at once (time to first bubble); later short ones are grouped
+            if len(self.pending) >= BUBBLE_MIN_CHARS or self.bubbles + len(bubbles) == 0:
+                bubbles.append(self.pending)
+                self.pending = ""
+        if final and self.pending:
+            bubbles.append(self.pending)
+            self.pending = ""
+        self.bubbles += len(bubbles)
+        return bubbles
+
+    def feed(self, token):
+        """Add a token, returning any bubbles that are now complete"""
+        self.text += token
+        new_text = self.visible()[self.emitted:]
+        boundaries = list(SENTENCE_END.finditer(new_text))
+        if not boundaries:
+            return []
+        consumed = boundaries[-1].end()
+        self.emitted += consumed
+        return self._group(SENTENCE_END.split(new_text[:consumed]))
+
+    def finish(self, current_mood):
+        """Flush the remaining text, returning (bubbles, full_visible_text, mood)"""
+        visible = self.visible(final=True)
+        bubbles = self._group(SENTENCE_END.split(visible[self.emitted:]), final=True)
+        self.emitted = len(visible)
+        full_text, mood = parse_mood(self.text, current_mood)
+        return bubbles, full_text, mood
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_bubble(text, sender=None):
+    bubble = {
+        "text": humanize_text(text.replace("[VOICE]", "").strip()),
+        "audio_url": None,
+        "is_voice_only": False,
+        "typing_delay": 0.0 # Real generation time is the delay now
+    }
+    if sender:
+        bubble["sender"] = sender
+    return bubble
+
+# --- GROUP CHAT ENGINE ---
+# Every member generates at the same time. The lead (the requested character)
+# gets the full context; each later member starts as soon as the previous
+# speaker has a first sentence (or GROUP_CONTEXT_CHARS of visible text) and
+# sees that partial reply.
+# Bubbles still come out in speaker order, so wall-clock time is roughly one
+# generation plus a short head start per extra member.
+class GroupSpeaker:
+    def __init__(self, char_id):
+        self.char_id = char_id
+        self.config = CHARACTERS[char_id]
+        self.name = self.config["name"]
+        self.stream = BubbleStream()
+        self.bubbles = asyncio.Queue() # bubble text, then None when finished
+        self.context_ready = asyncio.Event()
+        self.text = ""
+        self.error = None # Re-raised by run_group_chat once the replies are out
+
+def group_member_ids(lead_id):
+    """Speakers in order: the (resolved) lead, then the other GROUP_MEMBERS"""
+    lead_id = lead_id if lead_id in CHARACTERS else "alex"
+    return [lead_id] + [m for m in GROUP_MEMBERS if m != lead_id and m in CHARACTERS]
+
+def join_names(names):
+    return names[0] if len(names) == 1 else ", ".join(names[:-1]) + " and " + names[-1]
+
+def group_messages_for(request: ChatRequest, ctx, speakers, index):
+    speaker = speakers[index]
+    others = [s.name for s in speakers if s is not speaker]
+    if index == 0:
+        # --- SPLIT BRAIN STRATEGY ---
+        # 1. The lead reacts with the full context
+        verb = "is" if len(others) == 1 else "are"
+        persona = ctx["persona"] + f"\nCONTEXT: You are in a group chat with {join_names(others)} and the user. {join_names(others)} {verb} about to speak too. Reply to the user briefly."
+        history = history_compactor.window(ctx, request.history, persona, ctx["live_context"], request.message)
+        return build_prompt_messages(persona, history, ctx["live_context"], request.message)
+
+    # 2. Everyone else reacts to what the earlier speakers are saying
+    said = "\n".join(f'{s.name} just said: "{s.text}"' for s in speakers[:index])
+    persona = speaker.config.get("group_prompt") or speaker.config["prompt_base"]
+    persona = f"""{persona}
+CONTEXT: Group chat with {join_names(others)} and the user."""
+    # Only needs recent context
+    return build_prompt_messages(persona, [], f"{said}\nReply to the conversation.", request.message)
+
+async def _speak(request: ChatRequest, ctx, speakers, index):
+    speaker = speakers[index]
+    try:
+        if index > 0:
+            await speakers[index - 1].context_ready.wait()
+        payload = chat_payload(speaker.config, group_messages_for(request, ctx, speakers, index), stream=True)
+        async for chunk in ollama.stream(OLLAMA_CHAT_PATH, payload, user_id=ctx["user_id"]):
+            if chunk.get("done"):
+                llm_usage.record(speaker.char_id, chunk)
+            for text in speaker.stream.feed(chunk.get("message", {}).get("content", "")):
+                speaker.bubbles.put_nowait(text)
+            speaker.text = speaker.stream.visible().strip()
+            if len(speaker.text) >= GROUP_CONTEXT_CHARS or SENTENCE_END.search(speaker.text):
+                speaker.context_ready.set()
+        tail, speaker.text, _ = speaker.stream.finish(None)
+        for text in tail:
+            speaker.bubbles.put_nowait(text)
+    except Exception as e:
+        log.error("Group error (%s): %s", speaker.name, e)
+        speaker.error = e
+    finally:
+        speaker.context_ready.set() # Never leave the next speaker waiting
+        speaker.bubbles.put_nowait(None)
+
+async def run_group_chat(request: ChatRequest, ctx):
+    """Yield (sender, bubble_text) in speaker order while all members generate concurrently"""
+    speakers = [GroupSpeaker(c) for c in group_member_ids(ctx["char_id"])]
+    tasks = [asyncio.create_task(_speak(request, ctx, speakers, i)) for i in range(len(speakers))]
+    try:
+        for speaker in speakers:
+            while True:
+                text = await speaker.bubbles.get()
+                if text is None: break
+                yield speaker.name, text
+        # A failed member fails the turn (500, or 429 when Ollama is busy), like a DM
+        errors = [s.error for s in speakers if s.error]
+        if errors:
+            raise errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def generate_group_replies(request: ChatRequest, ctx):
+    replies = {}
+    async for sender, text in run_group_chat(request, ctx):
+        replies[sender] = replies[sender] + " " + text if sender in replies else text
+    return [{"sender": sender, "text": text} for sender, text in replies.items()]
+
+async def stream_chat_events(request: ChatRequest, ctx, started):
+    outcome = "error"
+    try:
+        if ctx["sarah_mode"]:
+            replies = {}
+            with timed_stage("llm"):
+                async for sender, text in run_group_chat(request, ctx):
+                    replies[sender] = replies[sender] + " " + text if sender in replies else text
+                    yield sse_event("message", stream_bubble(text, sender))
+            remember_turn(request, ctx)
+            outcome = "ok"
+            yield sse_event("done", {"group_messages": [{"sender": s, "text": t} for s, t in replies.items()]})
+            return
+
+        payload = chat_payload(ctx["char_config"], build_dm_messages(request, ctx), stream=True)
+        bubbles = BubbleStream()
+        llm_started = time.perf_counter()
+        ttft = None
+        with timed_stage("llm"):
+            async for chunk in ollama.stream(OLLAMA_CHAT_PATH, payload, user_id=ctx["user_id"]):
+                token = chunk.get("message", {}).get("content", "")
+                if token and ttft is None:
+                    ttft = time.perf_counter() - llm_started
+                if chunk.get("done"):
+                    llm_usage.record(ctx["char_id"], chunk, ttft)
+                for text in bubbles.feed(token):
+                    yield sse_event("message", stream_bubble(text))
+
+        tail, ai_text, new_mood = bubbles.finish(ctx["current_mood"])
+        for text in tail:
+            yield sse_event("message", stream_bubble(text))
+        await save_turn_state(ctx["char_id"], ctx["user_id"], new_mood)
+        remember_turn(request, ctx)
+        outcome = "ok"
+        yield sse_event("done", {"text": ai_text.replace("[VOICE]", "").strip()})
+    except Exception as e:
+        log.exception("Stream error: %s", e)
+        yield sse_event("error", {"detail": str(e)})
+    finally:
+        CHAT_REQUESTS.inc(endpoint="/chat/stream", outcome=outcome)
+        CHAT_SECONDS.observe(time.perf_counter() - started, endpoint="/chat/stream")
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """Server-Sent Events variant of /chat (events: message, done, error)"""
+    started = time.perf_counter()
+    try:
+        ollama_scheduler.check(user_id=check_user_id(request.user_id))
+        ctx = await build_chat_context(request)
+    except HTTPException:
+        raise
+    except OllamaBusy as e:
+        CHAT_REQUESTS.inc(endpoint="/chat/stream", outcome="busy")
+        raise busy_error(e)
+    except Exception as e:
+        log.exception("Chat error: %s", e)
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        stream_chat_events(request, ctx, started),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/clear")
-async def clear_memory():
+async def clear_memory(user_id: str = DEFAULT_USER):
+    user_id = check_user_id(user_id)
     try:
-        # 1. Clear ChromaDB
-        memory_system.client.delete_collection("chat_memory")
-        memory_system.collection = memory_system.client.get_or_create_collection(
-            name="chat_memory",
-            embedding_function=memory_system.embedding_fn
-        )
+        # 1. Clear this user's memories in ChromaDB
+        await memory_system.forget_user(user_id)
         
-        # 2. Reset Profile
-        if os.path.exists(PROFILE_FILE):
-            os.remove(PROFILE_FILE)
+        # 2. Reset Profile (and conversation summaries)
+        state_store.delete(user_path(user_id, PROFILE_FILE))
+        state_store.delete(user_path(user_id, SUMMARY_FILE))
             
         # 3. Reset State
-        if os.path.exists(STATE_FILE):
-            os.remove(STATE_FILE)
+        for char_id in CHARACTERS:
+            state_store.delete(character_state_path(char_id, user_id))
+
+        # 4. Stop proactive messages
+        job_scheduler.remove_user(user_id)
+        await state_store.flush()
             
         return {"status": "Memory wiped."}
     except Exception as e: